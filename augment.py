@@ -0,0 +1,176 @@
+'''On-the-fly synthetic spelling and splitting errors for training.
+
+Every epoch, each training example is re-corrupted from its clean target with probability
+augment_prob. A character is split into its two chaizi components (的 -> 白勺), or replaced by a
+character with the same pinyin or with the same leading wubi keys. Splits are aligned like
+process_src_tgt_to_equal_len: the target gets '#' followed by the merged character (src 白勺,
+tgt #的). The corruption depends only on (seed, epoch, index), so it is the same in any loader
+worker and after a resume.
+'''
+
+import random
+from collections import defaultdict
+
+from chaizi_index import load_chaizi
+
+
+MERGE_TOKEN = '#'
+
+
+def _is_cjk(token):
+    return len(token) == 1 and '一' <= token <= '鿿'
+
+
+def build_split_table(chaizi_to_char_dict, vocab):
+    '''{char id: (first component id, second component id)} for the two-part decompositions in vocab.'''
+    table = {}
+    for split, chars in chaizi_to_char_dict.items():
+        if len(split) != 2 or any(radical not in vocab for radical in split):
+            continue
+        for char in chars:
+            if char in vocab and char not in split:
+                table.setdefault(vocab[char], (vocab[split[0]], vocab[split[1]]))
+    return table
+
+
+def build_confusion_table(vocab, convertor, key_length=None):
+    '''
+    {char id: confusable char ids} over the CJK characters of vocab: characters whose code from
+    convertor (pho2_convertor, wubi_convertor) is the same, or the same in its first key_length symbols.
+    '''
+    chars = [token for token in vocab if _is_cjk(token)]
+    codes, lens = convertor.convert(chars)
+    groups = defaultdict(list)
+    for char, code, length in zip(chars, codes.tolist(), lens):
+        code = tuple(code[:int(length)])
+        if key_length is not None:
+            if len(code) < key_length:
+                continue
+            code = code[:key_length]
+        groups[code].append(vocab[char])
+    table = {}
+    for ids in groups.values():
+        if len(ids) > 1:
+            for i in ids:
+                table[i] = tuple(j for j in ids if j != i)
+    return table
+
+
+def clean_target(item, merge_id):
+    '''Ids of the target of item with the '#' of split characters removed.'''
+    tgt_idx = item['tgt_idx']
+    return [tgt_idx[0]] + [i for i in tgt_idx[1:-1] if i != merge_id] + [tgt_idx[-1]]
+
+
+def token_text(token):
+    '''Characters of a wordpiece token in the sentence; None for [UNK] and the other special tokens.'''
+    if len(token) > 2 and token.startswith('[') and token.endswith(']'):
+        return None
+    text = token[2:] if token.startswith('##') else token
+    return text if text else None
+
+
+class ErrorGenerator(object):
+    '''
+    Corrupts a clean target character by character: with split_prob a split, else with pho_prob a
+    homophone, else with wubi_prob a character of similar shape, at most max_errors per sentence.
+    '''
+
+    def __init__(self, tokens, merge_id, split_table, pho_table=None, wubi_table=None,
+                 split_prob=0.05, pho_prob=0.05, wubi_prob=0.03, max_errors=3):
+        self.tokens = tokens
+        self.merge_id = merge_id
+        self.split_table = split_table
+        self.pho_table = pho_table or {}
+        self.wubi_table = wubi_table or {}
+        self.split_prob = split_prob
+        self.pho_prob = pho_prob
+        self.wubi_prob = wubi_prob
+        self.max_errors = max_errors
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, chaizi_path, pho_convertor=None, wubi_convertor=None, wubi_keys=3, **kwargs):
+        vocab = tokenizer.vocab
+        tokens = tokenizer.convert_ids_to_tokens(list(range(len(vocab))))
+        split_table = build_split_table(load_chaizi(chaizi_path, vocab=vocab), vocab) if chaizi_path else {}
+        pho_table = build_confusion_table(vocab, pho_convertor) if pho_convertor is not None else None
+        wubi_table = build_confusion_table(vocab, wubi_convertor, key_length=wubi_keys) if wubi_convertor is not None else None
+        return cls(tokens, vocab[MERGE_TOKEN], split_table, pho_table, wubi_table, **kwargs)
+
+    def corrupt(self, item, rng):
+        '''
+        The src / tgt strings and tokens_size are rebuilt from the token ids, so they always match
+        them. Items with a token whose characters are unknown ([UNK]) are returned unchanged.
+        '''
+        ids = clean_target(item, self.merge_id)
+        texts = [token_text(self.tokens[token]) for token in ids[1:-1]]
+        if any(chars is None for chars in texts):
+            return item
+        src_idx, tgt_idx, tokens_size = [ids[0]], [ids[0]], []
+        src, tgt = [], []
+        errors = 0
+        for token, chars in zip(ids[1:-1], texts):
+            size = len(chars)
+            r = rng.random() if errors < self.max_errors else 1.0
+            if r < self.split_prob and token in self.split_table:
+                first, second = self.split_table[token]
+                src_idx += [first, second]
+                tgt_idx += [self.merge_id, token]
+                tokens_size += [1, 1]
+                src.append(self.tokens[first] + self.tokens[second])
+                tgt.append(MERGE_TOKEN + chars)
+                errors += 1
+                continue
+            confusions = None
+            if self.split_prob <= r < self.split_prob + self.pho_prob:
+                confusions = self.pho_table.get(token)
+            elif self.split_prob + self.pho_prob <= r < self.split_prob + self.pho_prob + self.wubi_prob:
+                confusions = self.wubi_table.get(token)
+            if confusions:
+                replacement = confusions[rng.randrange(len(confusions))]
+                src.append(self.tokens[replacement])
+                errors += 1
+            else:
+                replacement = token
+                src.append(chars)
+            src_idx.append(replacement)
+            tgt_idx.append(token)
+            tokens_size.append(size)
+            tgt.append(chars)
+        src_idx.append(ids[-1])
+        tgt_idx.append(ids[-1])
+        return {
+            'id': item['id'],
+            'src': ''.join(src),
+            'tgt': ''.join(tgt),
+            'tokens_size': tokens_size,
+            'src_idx': src_idx,
+            'tgt_idx': tgt_idx,
+            'lengths': len(src_idx) - 2,
+        }
+
+
+class AugmentedDataset(object):
+    '''
+    A list of training examples whose items are re-corrupted by generator with probability prob;
+    the other items are the original pairs. Call set_epoch before iterating an epoch.
+    '''
+
+    def __init__(self, dataset, generator, prob, seed=42):
+        self.dataset = dataset
+        self.generator = generator
+        self.prob = prob
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        rng = random.Random((self.seed * 1000003 + self.epoch) * 1000003 + index)
+        if rng.random() >= self.prob:
+            return self.dataset[index]
+        return self.generator.corrupt(self.dataset[index], rng)
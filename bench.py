@@ -0,0 +1,190 @@
+'''Throughput / latency benchmark of the registered model types on the bundled test sets.
+
+Every model type runs in its own process (randomly initialized from --model_name_or_path's config),
+so that startup time and peak memory are measured per model. Results are written as JSON;
+--compare checks them against an earlier run and exits non-zero on regressions.
+
+    python bench.py --model_name_or_path bert-base-chinese --output bench.json
+    python bench.py --model_name_or_path bert-base-chinese --output new.json --compare bench.json
+'''
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+DATA_FILES = ['data/News/src.test.txt', 'data/Social/src.test.txt']
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q) * 1000) if latencies else 0.0
+
+
+def bench_model(args, model_type):
+    '''Measure one model type in the current process.'''
+    start = time.perf_counter()
+    import torch
+    from run import MODEL_CLASSES, IMPORT_TIMES
+    from corrector import Corrector
+    config_class, model_class, tokenizer_class = MODEL_CLASSES[model_type]
+    import_s = time.perf_counter() - start
+
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.threads)
+    start = time.perf_counter()
+    config = config_class.from_pretrained(args.model_name_or_path)
+    config.image_model_type = 0
+    config.num_fonts = 1
+    config.with_pho = config.with_res = 'yes'
+    config.fusion = 'gate'
+    tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
+    model = model_class(config)
+    model.eval()
+    device = torch.device('cpu')
+    corrector = Corrector(model, tokenizer, model_class.build_batch, device, max_seq_length=args.max_seq_length)
+    load_s = time.perf_counter() - start
+
+    results = []
+    for data_file in args.data_files:
+        with open(data_file, 'r', encoding='utf-8') as f:
+            sentences = [line.strip() for line in f][:args.num_sentences]
+        for batch_size in args.batch_sizes:
+            batches = [sentences[i:i + batch_size] for i in range(0, len(sentences), batch_size)]
+            for chunk in batches[:args.warmup_batches]:
+                corrector.forward(corrector.featurize(chunk))
+            featurize_s, latencies = 0.0, []
+            total_start = time.perf_counter()
+            for chunk in batches:
+                start = time.perf_counter()
+                batch = corrector.featurize(chunk)
+                featurize_s += time.perf_counter() - start
+                start = time.perf_counter()
+                corrector.forward(batch)
+                latencies.append(time.perf_counter() - start)
+            total_s = time.perf_counter() - total_start
+            results.append({
+                'model_type': model_type,
+                'data_file': data_file,
+                'batch_size': batch_size,
+                'sentences': len(sentences),
+                'sentences_per_sec': len(sentences) / total_s,
+                'featurize_ms_per_batch': featurize_s / len(batches) * 1000,
+                'latency_p50_ms': percentile_ms(latencies, 50),
+                'latency_p95_ms': percentile_ms(latencies, 95),
+                'latency_p99_ms': percentile_ms(latencies, 99),
+            })
+            logger.info("%s %s bs=%d: %.1f sent/s, p50 %.1f ms, p95 %.1f ms", model_type, data_file, batch_size,
+                        results[-1]['sentences_per_sec'], results[-1]['latency_p50_ms'], results[-1]['latency_p95_ms'])
+    return {
+        'model_type': model_type,
+        'import_s': import_s,
+        'import_times': dict(IMPORT_TIMES),
+        'startup_s': load_s,
+        'num_parameters': sum(p.numel() for p in model.parameters()),
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'results': results,
+    }
+
+
+def run_isolated(args, model_type):
+    command = [sys.executable, os.path.abspath(__file__), '--worker', model_type,
+               '--model_name_or_path', args.model_name_or_path, '--max_seq_length', str(args.max_seq_length),
+               '--num_sentences', str(args.num_sentences), '--warmup_batches', str(args.warmup_batches),
+               '--threads', str(args.threads), '--seed', str(args.seed),
+               '--batch_sizes'] + [str(b) for b in args.batch_sizes] + ['--data_files'] + args.data_files
+    start = time.perf_counter()
+    process = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        return {'model_type': model_type, 'error': 'exit code %d' % process.returncode}
+    report = json.loads(process.stdout.strip().splitlines()[-1])
+    report['process_s'] = time.perf_counter() - start
+    return report
+
+
+def compare(current, baseline, tolerance):
+    '''Regressions of current against baseline: throughput down or p95 latency up by more than tolerance.'''
+    def index(report):
+        return dict(((r['model_type'], r['data_file'], r['batch_size']), r)
+                    for model in report['models'] for r in model.get('results', []))
+    old, new = index(baseline), index(current)
+    regressions = []
+    for key in sorted(set(old) & set(new)):
+        for metric, worse in (('sentences_per_sec', -1), ('latency_p95_ms', 1)):
+            change = (new[key][metric] - old[key][metric]) / old[key][metric] if old[key][metric] else 0.0
+            print('%-50s %-28s bs=%-4d %-18s %10.2f -> %10.2f (%+.1f%%)' % (
+                key[0], key[1], key[2], metric, old[key][metric], new[key][metric], 100 * change))
+            if change * worse > tolerance:
+                regressions.append((key, metric, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name_or_path", required=True, type=str,
+                        help="Directory with the BERT config and vocab the models are built from")
+    parser.add_argument("--model_types", nargs='*', default=None,
+                        help="Model types to benchmark, default all of MODEL_CLASSES")
+    parser.add_argument("--data_files", nargs='*', default=DATA_FILES)
+    parser.add_argument("--batch_sizes", nargs='*', type=int, default=[1, 8, 32])
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--num_sentences", default=256, type=int,
+                        help="Sentences taken from the head of every data file")
+    parser.add_argument("--warmup_batches", default=2, type=int)
+    parser.add_argument("--threads", default=1, type=int, help="torch intra-op threads")
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--output", default='bench.json', type=str)
+    parser.add_argument("--compare", default='', type=str, help="Earlier output to check for regressions")
+    parser.add_argument("--tolerance", default=0.1, type=float, help="Relative change counted as a regression")
+    parser.add_argument("--worker", default='', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO, stream=sys.stderr)
+
+    if args.worker:
+        print(json.dumps(bench_model(args, args.worker)))
+        return
+
+    if args.model_types is None:
+        from run import MODEL_CLASSES
+        args.model_types = list(MODEL_CLASSES)
+    import torch
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'threads': args.threads,
+        },
+        'settings': dict((k, v) for k, v in vars(args).items() if k not in ('worker', 'compare', 'output')),
+        'models': [run_isolated(args, model_type) for model_type in args.model_types],
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    logger.info("Benchmark written to %s", args.output)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            logger.error("%d regressions beyond %.0f%%", len(regressions), 100 * args.tolerance)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+'''Index over chaizi (character decomposition) data for splitting errors, e.g. 白勺 -> 的, 田心 -> 思.
+
+The decompositions are compiled into an Aho-Corasick automaton, so that every span of adjacent
+characters recomposing into a valid character is found in one pass over a sentence.
+'''
+
+from collections import deque
+
+
+def load_chaizi(chaizi_path, vocab=None):
+    '''
+    Read a chaizi file (char \\t ... \\t space separated radicals) into {decomposition: chars}.
+    With a vocab, decompositions using radicals outside it are skipped, as in get_chaizi_dict.
+    '''
+    chaizi_to_char_dict = {}
+    with open(chaizi_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            elements = line.strip().split('\t')
+            if len(elements) < 2:
+                continue
+            char, split = elements[0], elements[-1].replace(' ', '')
+            if vocab is not None and any(radical not in vocab for radical in split):
+                continue
+            if split in chaizi_to_char_dict:
+                if char not in chaizi_to_char_dict[split]:
+                    chaizi_to_char_dict[split] += char
+            else:
+                chaizi_to_char_dict[split] = char
+    return chaizi_to_char_dict
+
+
+class ChaiziIndex(object):
+
+    def __init__(self, chaizi_to_char_dict, min_parts=2):
+        # Trie: goto[node] maps a radical to the child node; chars[node] is set on the node
+        # ending a decomposition; fail / dict_link are the Aho-Corasick suffix links.
+        self.goto = [{}]
+        self.chars = [None]
+        self.depth = [0]
+        self.components = set()
+        for split, chars in chaizi_to_char_dict.items():
+            if len(split) < min_parts:
+                continue
+            self.components.update(split)
+            node = 0
+            for radical in split:
+                nxt = self.goto[node].get(radical)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][radical] = nxt
+                    self.goto.append({})
+                    self.chars.append(None)
+                    self.depth.append(self.depth[node] + 1)
+                node = nxt
+            self.chars[node] = chars
+        self._build_links()
+
+    @classmethod
+    def from_file(cls, chaizi_path, vocab=None, min_parts=2):
+        return cls(load_chaizi(chaizi_path, vocab=vocab), min_parts=min_parts)
+
+    def _build_links(self):
+        self.fail = [0] * len(self.goto)
+        self.dict_link = [-1] * len(self.goto)
+        todo = deque(self.goto[0].values())
+        while todo:
+            node = todo.popleft()
+            for radical, child in self.goto[node].items():
+                f = self.fail[node]
+                while f and radical not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(radical, 0)
+                self.fail[child] = f
+                self.dict_link[child] = f if self.chars[f] is not None else self.dict_link[f]
+                todo.append(child)
+
+    def __len__(self):
+        return sum(chars is not None for chars in self.chars)
+
+    def __contains__(self, span):
+        return self.recompose(span) is not None
+
+    def is_component(self, char):
+        return char in self.components
+
+    def recompose(self, span):
+        '''Characters decomposing into exactly span, or None.'''
+        node = 0
+        for radical in span:
+            node = self.goto[node].get(radical)
+            if node is None:
+                return None
+        return self.chars[node]
+
+    def scan(self, chars):
+        '''
+        Streaming search: consume an iterable of characters and yield (start, end, candidates)
+        as soon as a span chars[start:end] recomposing into candidates has been read.
+        Linear in the input length plus the number of matches.
+        '''
+        node = 0
+        for pos, char in enumerate(chars):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            match = node if self.chars[node] is not None else self.dict_link[node]
+            while match > 0:
+                yield pos + 1 - self.depth[match], pos + 1, self.chars[match]
+                match = self.dict_link[match]
+
+    def find_spans(self, sentence):
+        return list(self.scan(sentence))
@@ -0,0 +1,258 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import torch
+
+
+# Same as transformers.WEIGHTS_NAME; not imported from there so that loading this module stays cheap
+WEIGHTS_NAME = 'pytorch_model.bin'
+
+
+logger = logging.getLogger(__name__)
+
+# Rendered glyphs can be rebuilt from the fonts, so they are kept once in a glyph cache
+# and every checkpoint only stores a pointer to it. The glyph tables (models.GlyphTable) are
+# outside the state dict; GLYPH_KEYS are the state dict entries of the older float glyphs.
+GLYPH_KEYS = ('char_images.weight', 'char_images_multifonts')
+GLYPH_CACHE_NAME = 'glyph_cache.bin'
+GLYPH_POINTER_NAME = 'glyph_cache.json'
+TRAINING_STATE_NAME = 'training_state.bin'
+
+
+def glyph_tables(model):
+    return dict((name, module) for name, module in model.named_modules() if hasattr(module, 'glyph_state'))
+
+
+def save_glyph_cache(model, path):
+    glyphs = dict((name, table.glyph_state()) for name, table in glyph_tables(model).items())
+    if len(glyphs) == 0:
+        return None
+    tmp_path = path + '.tmp'
+    torch.save(glyphs, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def restore_glyphs(model, glyphs):
+    '''
+    Load glyphs, {table name: glyph_state} of a glyph cache or the older float glyphs
+    {GLYPH_KEYS entry: tensor}, into the glyph tables of model; returns the names of the tables restored.
+    '''
+    tables = glyph_tables(model)
+    restored = []
+    for name, state in glyphs.items():
+        if name in GLYPH_KEYS:
+            name = name[:-len('.weight')] if name.endswith('.weight') else name
+            if name in tables:
+                tables[name].set_normalized(state)
+                restored.append(name)
+        elif name in tables:
+            tables[name].load_glyph_state(state)
+            restored.append(name)
+    return restored
+
+
+def load_glyph_cache(model, path):
+    return restore_glyphs(model, torch.load(path, map_location='cpu'))
+
+
+def rebuild_glyphs(model, args):
+    '''Render the glyphs of model from the fonts given by (training) args.'''
+    if args.num_fonts == 1:
+        model.build_glyce_embed(args.model_name_or_path, args.font_path)
+    else:
+        model.build_glyce_embed_multifonts(args.model_name_or_path, args.num_fonts, args.use_traditional_font)
+
+
+def to_cpu(obj):
+    '''Recursively copy the tensors in (nested) dicts, lists and tuples to CPU.'''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def snapshot_state_dict(model):
+    '''Copy the weights to CPU so that training can go on while they are written.'''
+    state_dict = model.state_dict()
+    return dict((k, v.detach().to('cpu', copy=True)) for k, v in state_dict.items() if k not in GLYPH_KEYS)
+
+
+def write_checkpoint(output_dir, config, state_dict, args, glyph_cache_path=None, extra_files=None):
+    '''
+    Every file (the config included) is first written to a temporary directory inside output_dir
+    and then renamed into place. The weights go last, so a directory only looks like a checkpoint
+    (WEIGHTS_NAME exists) once all its files are complete.
+    '''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-checkpoint-', dir=output_dir)
+    try:
+        config.save_pretrained(tmp_dir)
+        torch.save(args, os.path.join(tmp_dir, 'training_args.bin'))
+        if glyph_cache_path is not None:
+            with open(os.path.join(tmp_dir, GLYPH_POINTER_NAME), 'w', encoding='utf-8') as f:
+                json.dump({'glyph_cache': os.path.abspath(glyph_cache_path)}, f)
+        for name, obj in (extra_files or {}).items():
+            torch.save(obj, os.path.join(tmp_dir, name))
+        torch.save(state_dict, os.path.join(tmp_dir, WEIGHTS_NAME))
+        for name in sorted(os.listdir(tmp_dir), key=lambda name: name == WEIGHTS_NAME):
+            os.replace(os.path.join(tmp_dir, name), os.path.join(output_dir, name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def save_checkpoint(model, output_dir, args, glyph_cache_path=None, extra_files=None):
+    model_to_save = model.module if hasattr(model, 'module') else model  # Take care of distributed/parallel training
+    write_checkpoint(output_dir, model_to_save.config, snapshot_state_dict(model_to_save), args,
+                     glyph_cache_path=glyph_cache_path, extra_files=extra_files)
+
+
+def load_checkpoint(model_class, checkpoint, config=None, build_glyphs=None):
+    '''
+    from_pretrained, then restore the glyph tables: from the glyph cache the checkpoint points to,
+    else from the float glyphs in the weights of older checkpoints, else by rendering them again
+    with build_glyphs(model) (by default rebuild_glyphs with the checkpoint's training args).
+    Raises rather than leaving a model that uses glyphs with blank ones.
+    '''
+    model = model_class.from_pretrained(checkpoint, config=config)
+    tables = glyph_tables(model)
+    if len(tables) == 0 or getattr(model.config, 'with_res', 'yes') != 'yes':
+        return model
+
+    missing = set(tables)
+    pointer_path = os.path.join(checkpoint, GLYPH_POINTER_NAME)
+    if os.path.exists(pointer_path):
+        with open(pointer_path, encoding='utf-8') as f:
+            glyph_cache_path = json.load(f)['glyph_cache']
+        if os.path.exists(glyph_cache_path):
+            missing -= set(load_glyph_cache(model, glyph_cache_path))
+        else:
+            logger.warning("Glyph cache %s of checkpoint %s is missing", glyph_cache_path, checkpoint)
+    if missing:
+        state_dict = torch.load(os.path.join(checkpoint, WEIGHTS_NAME), map_location='cpu')
+        missing -= set(restore_glyphs(model, dict((k, v) for k, v in state_dict.items() if k in GLYPH_KEYS)))
+        del state_dict
+    if missing:
+        args_path = os.path.join(checkpoint, 'training_args.bin')
+        if build_glyphs is None and os.path.exists(args_path):
+            training_args = torch.load(args_path)
+            build_glyphs = lambda model: rebuild_glyphs(model, training_args)
+        if build_glyphs is None:
+            raise ValueError("Checkpoint %s has no glyphs for %s and they cannot be rebuilt" % (checkpoint, ', '.join(sorted(missing))))
+        logger.warning("Checkpoint %s has no glyphs for %s, rendering them again", checkpoint, ', '.join(sorted(missing)))
+        build_glyphs(model)
+    return model
+
+
+def checkpoint_id(checkpoint):
+    '''Cheap identity of a checkpoint directory: path, size and mtime of its weights and config.'''
+    parts = [os.path.abspath(checkpoint)]
+    for name in (WEIGHTS_NAME, 'config.json', GLYPH_POINTER_NAME):
+        path = os.path.join(checkpoint, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append('%s:%d:%d' % (name, stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+class AsyncCheckpointWriter(object):
+    '''
+    Writes checkpoints in a background thread. The state dict is snapshotted to CPU
+    on the calling thread; at most one write is in flight at a time.
+    '''
+    def __init__(self, glyph_cache_path=None):
+        self.glyph_cache_path = glyph_cache_path
+        self._thread = None
+        self._error = None
+
+    def save(self, model, output_dir, args, extra_files=None):
+        self.wait()
+        model_to_save = model.module if hasattr(model, 'module') else model  # Take care of distributed/parallel training
+        kwargs = {
+            'output_dir': output_dir,
+            'config': copy.deepcopy(model_to_save.config),
+            'state_dict': snapshot_state_dict(model_to_save),
+            'args': copy.copy(args),
+            'glyph_cache_path': self.glyph_cache_path,
+            'extra_files': to_cpu(extra_files),
+        }
+        self._thread = threading.Thread(target=self._write, kwargs=kwargs, daemon=True)
+        self._thread.start()
+
+    def _write(self, **kwargs):
+        try:
+            write_checkpoint(**kwargs)
+            logger.info("Saved model checkpoint to %s", kwargs['output_dir'])
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+class BestCheckpoints(object):
+    '''
+    The num_keep best checkpoints by an eval metric, maintained while training: a checkpoint is
+    only written when it makes the cut, and the one it pushes out is deleted.
+    '''
+    def __init__(self, writer, num_keep, higher_is_better=True):
+        self.writer = writer
+        self.num_keep = num_keep
+        self.higher_is_better = higher_is_better
+        self.kept = []  # (value, output_dir), best first
+
+    def _sort(self):
+        self.kept.sort(key=lambda x: x[0], reverse=self.higher_is_better)
+
+    def would_keep(self, value):
+        if len(self.kept) < self.num_keep:
+            return True
+        worst = self.kept[-1][0]
+        return value > worst if self.higher_is_better else value < worst
+
+    def update(self, value, model, output_dir, args, training_state=None):
+        '''
+        Save model to output_dir if value is among the best, returns whether it was saved.
+        training_state() gives the extra files of the checkpoint; it is called once the checkpoint
+        is in kept, so a state_dict taken there already lists it.
+        '''
+        if not self.would_keep(value):
+            return False
+        self.kept.append((value, output_dir))
+        self._sort()
+        removed = self.kept[self.num_keep:]
+        del self.kept[self.num_keep:]
+        self.writer.save(model, output_dir, args, extra_files=training_state() if training_state is not None else None)
+        for _, path in removed:
+            self.writer.wait()
+            logger.info("Deleting ckpt: %s", path)
+            shutil.rmtree(path, ignore_errors=True)
+        return True
+
+    def state_dict(self):
+        return {'kept': list(self.kept)}
+
+    def load_state_dict(self, state):
+        '''Restore the kept checkpoints of a resumed run, dropping the ones no longer on disk.'''
+        self.kept = []
+        for value, path in state['kept']:
+            if os.path.exists(os.path.join(path, WEIGHTS_NAME)):
+                self.kept.append((value, path))
+            else:
+                logger.warning("Best checkpoint %s of the resumed run is missing, it is no longer tracked", path)
+        self._sort()
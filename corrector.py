@@ -0,0 +1,562 @@
+'''Inference pipeline: raw sentences in, corrected sentences out.
+
+A rule stage merges split characters (白勺 -> 的) found with the chaizi index and scored with a
+character n-gram model; only the sentences it cannot settle go through the neural model.
+'''
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import hashlib
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import torch
+
+from chaizi_index import ChaiziIndex
+from edit_tags import merge_decode
+from profiling import BranchProfiler, section
+
+
+logger = logging.getLogger(__name__)
+
+# Batch fields that stay on the host
+HOST_KEYS = ['id', 'src', 'tgt', 'lengths', 'tokens_size', 'pho_lens', 'pos_lens', 'wubi_lens']
+
+MERGE_TOKEN = '#'
+
+SENTENCE_ENDS = set('。！？；!?;…\n')
+CLOSING_QUOTES = set('”’」』）)')
+
+
+def _is_chinese(char):
+    cp = ord(char)
+    return ((0x4E00 <= cp <= 0x9FFF) or (0x3400 <= cp <= 0x4DBF) or (0x20000 <= cp <= 0x2A6DF) or
+            (0x2A700 <= cp <= 0x2B73F) or (0x2B740 <= cp <= 0x2B81F) or (0x2B820 <= cp <= 0x2CEAF) or
+            (0xF900 <= cp <= 0xFAFF) or (0x2F800 <= cp <= 0x2FA1F))
+
+
+def segment(text):
+    '''(start, end) offsets of the sentences of text; a sentence ends after a run of end punctuation and closing quotes.'''
+    spans, start, i = [], 0, 0
+    while i < len(text):
+        if text[i] in SENTENCE_ENDS:
+            while i + 1 < len(text) and (text[i + 1] in SENTENCE_ENDS or text[i + 1] in CLOSING_QUOTES):
+                i += 1
+            spans.append((start, i + 1))
+            start = i + 1
+        i += 1
+    if start < len(text):
+        spans.append((start, len(text)))
+    return spans
+
+
+def make_windows(text, max_chars, overlap):
+    '''
+    Pack the sentences of text into windows of at most max_chars characters. Each window is
+    (window_start, core_start, core_end): the cores tile the text, and up to overlap characters on
+    each side of a core are only there as context. Sentences longer than a core are cut.
+    '''
+    core_size = max_chars - 2 * overlap
+    if core_size <= 0:
+        raise ValueError('overlap %d leaves no room in windows of %d characters' % (overlap, max_chars))
+    cores = []
+    for start, end in segment(text):
+        for piece_start in range(start, end, core_size):
+            piece_end = min(end, piece_start + core_size)
+            if cores and piece_end - cores[-1][0] <= core_size:
+                cores[-1] = (cores[-1][0], piece_end)
+            else:
+                cores.append((piece_start, piece_end))
+    return [(max(0, start - overlap), start, end) for start, end in cores]
+
+
+class CharNgramModel(object):
+    '''Character bigram model with add-k smoothing, cheap enough to score every candidate merge.'''
+
+    BOS, EOS = '<s>', '</s>'
+
+    def __init__(self, k=0.1):
+        self.k = k
+        self.unigrams = defaultdict(int)
+        self.bigrams = defaultdict(int)
+        self.total = 0
+
+    def fit(self, sentences):
+        for sentence in sentences:
+            chars = [self.BOS] + list(sentence.replace(MERGE_TOKEN, '')) + [self.EOS]
+            for prev, char in zip(chars, chars[1:]):
+                self.unigrams[prev] += 1
+                self.bigrams[prev, char] += 1
+                self.total += 1
+        return self
+
+    @classmethod
+    def from_files(cls, paths, k=0.1):
+        model = cls(k=k)
+        for path in paths:
+            with open(path, 'r', encoding='utf-8') as f:
+                model.fit(line.strip() for line in f)
+        return model
+
+    def char_logprob(self, prev, char):
+        vocab_size = len(self.unigrams) + 1
+        return math.log((self.bigrams.get((prev, char), 0) + self.k) / (self.unigrams.get(prev, 0) + self.k * vocab_size))
+
+    def logprobs(self, text, bos=True, eos=True):
+        '''Log probability of each transition in text.'''
+        chars = ([self.BOS] if bos else []) + list(text) + ([self.EOS] if eos else [])
+        return [self.char_logprob(prev, char) for prev, char in zip(chars, chars[1:])]
+
+    def logprob(self, text, bos=True, eos=True):
+        return sum(self.logprobs(text, bos=bos, eos=eos))
+
+
+class SplitMerger(object):
+    '''
+    Rule stage for splitting errors. Every span recomposing into a character is a candidate merge;
+    its gain is the n-gram log-probability difference of the local context with and without the merge.
+    Merges with gain >= margin are applied, those within (-margin, margin) make the sentence ambiguous.
+    '''
+
+    def __init__(self, index, lm, margin=2.0, context=2):
+        self.index = index
+        self.lm = lm
+        self.margin = margin
+        self.context = context
+
+    def _gain(self, sentence, start, end, char):
+        left = sentence[max(0, start - self.context):start]
+        right = sentence[end:end + self.context]
+        bos = start - self.context <= 0
+        eos = end + self.context >= len(sentence)
+        merged = self.lm.logprob(left + char + right, bos=bos, eos=eos)
+        original = self.lm.logprob(left + sentence[start:end] + right, bos=bos, eos=eos)
+        return merged - original
+
+    def propose(self, sentence):
+        '''[(gain, start, end, char)] for every candidate merge, best first.'''
+        candidates = []
+        for start, end, chars in self.index.scan(sentence):
+            for char in chars:
+                candidates.append((self._gain(sentence, start, end, char), start, end, char))
+        candidates.sort(key=lambda c: (-c[0], c[1]))
+        return candidates
+
+    def resolve(self, sentence):
+        '''
+        Returns (merged sentence, edits, ambiguous). edits are (start, end, char) on the input;
+        non-overlapping merges are taken greedily by gain.
+        '''
+        taken = [False] * len(sentence)
+        edits = []
+        ambiguous = False
+        for gain, start, end, char in self.propose(sentence):
+            if any(taken[start:end]):
+                continue
+            if gain >= self.margin:
+                edits.append((start, end, char))
+                for i in range(start, end):
+                    taken[i] = True
+            elif gain > -self.margin:
+                ambiguous = True
+        edits.sort()
+        merged, last = [], 0
+        for start, end, char in edits:
+            merged.append(sentence[last:start])
+            merged.append(char)
+            last = end
+        merged.append(sentence[last:])
+        return ''.join(merged), edits, ambiguous
+
+    def suspicious(self, sentence, threshold):
+        '''
+        Whether some transition of the sentence is less likely than threshold under the n-gram model.
+        Without a threshold there is no detector and every sentence is suspicious.
+        '''
+        if threshold is None:
+            return True
+        return len(sentence) > 0 and min(self.lm.logprobs(sentence)) < threshold
+
+
+class ResultCache(object):
+    '''
+    Sentence -> correction cache in front of the model. Keys hash the raw sentence (the stored output
+    is its surface text) together with a namespace (checkpoint id and decoding settings), so a new
+    checkpoint never sees old results.
+    An in-memory LRU with optional TTL sits over an optional sqlite file shared between processes.
+    '''
+
+    def __init__(self, namespace, capacity=100000, ttl=None, disk_path=None):
+        self.namespace = namespace
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.stats = defaultdict(int)
+        self.lock = threading.Lock()
+        self.db = None
+        if disk_path:
+            self.db = sqlite3.connect(disk_path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, time REAL)')
+
+    def key(self, sentence):
+        text = self.namespace + '\0' + sentence
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def _remember(self, key, value, stored_at):
+        self.entries[key] = (value, stored_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def get(self, sentence):
+        key = self.key(sentence)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry[1]):
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+            if self.db is not None:
+                row = self.db.execute('SELECT value, time FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None and not self._expired(row[1]):
+                    self._remember(key, row[0], row[1])
+                    self.stats['hits'] += 1
+                    self.stats['disk_hits'] += 1
+                    return row[0]
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, sentence, value):
+        key = self.key(sentence)
+        stored_at = time.time()
+        with self.lock:
+            self._remember(key, value, stored_at)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', (key, value, stored_at))
+                self.db.commit()
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+
+class Corrector(object):
+    '''
+    Wraps a model for sentence correction. Sentences are mapped to vocab ids character by character,
+    so predictions line up with the input; non Chinese characters are never changed.
+    '''
+
+    def __init__(self, model, tokenizer, batch_processor, device, max_seq_length=128, batch_size=32,
+                 merger=None, detect_threshold=None, max_rounds=1, result_cache=None, profiler=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.batch_processor = batch_processor
+        self.device = device
+        self.max_seq_length = max_seq_length
+        self.batch_size = batch_size
+        self.merger = merger
+        self.detect_threshold = detect_threshold
+        self.max_rounds = max_rounds
+        self.result_cache = result_cache
+        self.profiler = profiler
+        self.vocab = tokenizer.vocab
+        self.unk_id = self.vocab[tokenizer.unk_token]
+        self.stats = defaultdict(int)
+
+    def _char_id(self, char):
+        return self.vocab.get(char, self.vocab.get(char.lower(), self.unk_id))
+
+    def featurize(self, sentences):
+        max_chars = self.max_seq_length - 2
+        ids = [[self.tokenizer.cls_token_id] + [self._char_id(c) for c in s[:max_chars]] + [self.tokenizer.sep_token_id]
+               for s in sentences]
+        max_length = max(len(x) for x in ids)
+        batch = {
+            'id': list(range(len(sentences))),
+            'src': list(sentences),
+            'tgt': list(sentences),
+            'tokens_size': [[1] * (len(x) - 2) for x in ids],
+            'lengths': [len(x) - 2 for x in ids],
+        }
+        src_idx = [x + [0] * (max_length - len(x)) for x in ids]
+        batch['src_idx'] = torch.tensor(src_idx, dtype=torch.long)
+        # The models compare predictions with tgt_idx, give them the input so no labels are needed
+        batch['tgt_idx'] = batch['src_idx'].clone()
+        batch['masks'] = torch.tensor([[1] * len(x) + [0] * (max_length - len(x)) for x in ids], dtype=torch.long)
+        batch['loss_masks'] = torch.tensor([[0] + [1] * (len(x) - 2) + [0] * (max_length - len(x) + 1) for x in ids], dtype=torch.long)
+        with section('build_batch'):
+            return self.batch_processor(batch, self.tokenizer)
+
+    def to_device(self, batch):
+        for t in batch:
+            if t not in HOST_KEYS:
+                batch[t] = batch[t].to(self.device)
+        return batch
+
+    def forward(self, batch):
+        self.model.eval()
+        with torch.no_grad():
+            batch = self.to_device(batch)
+            if self.profiler is None:
+                outputs = self.model(batch)
+            else:
+                with self.profiler.forward():
+                    outputs = self.model(batch)
+                self.profiler.step()
+        # outputs are (loss, logits, ...) since tgt_idx is always given
+        preds = outputs[1].argmax(dim=-1).cpu()
+        if hasattr(self.model, 'edit_classifier'):
+            # Edit-tagging models never predict '#': decode their merges into the '#'-aligned form
+            edit_preds = outputs[3].argmax(dim=-1).cpu().numpy()
+            _, aligned = merge_decode(batch['src_idx'].cpu().numpy(), edit_preds, preds.numpy(), batch['lengths'],
+                                      self.tokenizer.convert_tokens_to_ids(MERGE_TOKEN))
+            preds = torch.from_numpy(aligned)
+        return preds
+
+    def decode_aligned(self, sentence, pred_ids):
+        '''The output for each input character: a character, or '' for the first half of a merge.'''
+        tokens = self.tokenizer.convert_ids_to_tokens(pred_ids[1:len(pred_ids) - 1])
+        out = []
+        for i, char in enumerate(sentence):
+            token = tokens[i] if i < len(tokens) else char
+            if token == MERGE_TOKEN and _is_chinese(char):
+                out.append('')
+            elif len(token) == 1 and _is_chinese(token) and _is_chinese(char):
+                out.append(token)
+            else:
+                out.append(char)
+        return out
+
+    def decode(self, sentence, pred_ids):
+        return ''.join(self.decode_aligned(sentence, pred_ids))
+
+    def predict_aligned(self, sentences):
+        '''Neural correction of every sentence, aligned with the input characters.'''
+        corrected = []
+        for start in range(0, len(sentences), self.batch_size):
+            chunk = sentences[start:start + self.batch_size]
+            with section('featurize'):
+                batch = self.featurize(chunk)
+            preds = self.forward(batch)
+            for i, sentence in enumerate(chunk):
+                length = min(len(sentence), self.max_seq_length - 2) + 2
+                corrected.append(self.decode_aligned(sentence, preds[i, :length].tolist()))
+            self.stats['model_sentences'] += len(chunk)
+        return corrected
+
+    def predict(self, sentences):
+        '''Neural correction of every sentence.'''
+        return [''.join(out) for out in self.predict_aligned(sentences)]
+
+    def refine(self, sentences):
+        '''
+        Iterative correction: each round feeds the previous output back to the model, until a
+        sentence comes back unchanged or max_rounds is reached. Converged sentences leave the batch.
+        '''
+        current = list(sentences)
+        active = list(range(len(current)))
+        for _ in range(self.max_rounds):
+            if not active:
+                break
+            changed = []
+            for i, pred in zip(active, self.predict([current[i] for i in active])):
+                if pred != current[i]:
+                    changed.append(i)
+                current[i] = pred
+            self.stats['refine_rounds'] += 1
+            active = changed
+        self.stats['refine_unconverged'] += len(active)
+        return current
+
+    def correct(self, sentences):
+        '''
+        With a result cache, sentences seen before (and duplicates within the input) are answered
+        without featurizing them; only the distinct uncached ones go through the pipeline.
+        '''
+        sentences = list(sentences)
+        self.stats['sentences'] += len(sentences)
+        if self.result_cache is None:
+            return self._correct(sentences)
+        corrected = [self.result_cache.get(sentence) for sentence in sentences]
+        todo = OrderedDict()
+        for i, sentence in enumerate(sentences):
+            if corrected[i] is None:
+                todo.setdefault(sentence, []).append(i)
+        results = self._correct([sentences[positions[0]] for positions in todo.values()])
+        for positions, result in zip(todo.values(), results):
+            self.result_cache.put(sentences[positions[0]], result)
+            for i in positions:
+                corrected[i] = result
+        self.stats['cached_sentences'] += len(sentences) - len(todo)
+        return corrected
+
+    def _correct(self, sentences):
+        '''
+        With a merger, split characters are merged by rules first. With --detect_threshold only the
+        sentences that are ambiguous or flagged by the n-gram detector are sent to the model,
+        without it all of them are (the rules alone do not fix spelling errors).
+        '''
+        if self.merger is None:
+            return self.refine(sentences)
+        corrected = [None] * len(sentences)
+        todo = []
+        for i, sentence in enumerate(sentences):
+            merged, edits, ambiguous = self.merger.resolve(sentence)
+            self.stats['rule_merges'] += len(edits)
+            if ambiguous or self.merger.suspicious(merged, self.detect_threshold):
+                todo.append(i)
+            corrected[i] = merged
+        for i, pred in zip(todo, self.refine([corrected[i] for i in todo])):
+            corrected[i] = pred
+        self.stats['fast_path_sentences'] += len(sentences) - len(todo)
+        return corrected
+
+
+    def correct_documents(self, documents, overlap=16):
+        '''
+        Streaming correction of long documents. Each document is cut into overlapping windows
+        (see make_windows), windows of consecutive documents share batches, and the corrected
+        cores are stitched back at their offsets. Yields corrected documents in input order as soon
+        as all their windows are done. One model pass per window, without the rule stage.
+        '''
+        max_chars = self.max_seq_length - 2
+        pending = []  # (doc index, window start, core start, core end)
+        docs = {}  # doc index -> [text, {core start: corrected core}, windows left]
+        next_doc = 0
+
+        def run(windows):
+            texts = [docs[d][0][w_start:c_end + overlap] for d, w_start, c_start, c_end in windows]
+            for (d, w_start, c_start, c_end), out in zip(windows, self.predict_aligned(texts)):
+                docs[d][1][c_start] = ''.join(out[c_start - w_start:c_end - w_start])
+                docs[d][2] -= 1
+
+        for d, text in enumerate(documents):
+            windows = make_windows(text, max_chars, overlap)
+            docs[d] = [text, {}, len(windows)]
+            pending.extend((d, w_start, c_start, c_end) for w_start, c_start, c_end in windows)
+            self.stats['documents'] += 1
+            self.stats['windows'] += len(windows)
+            while len(pending) >= self.batch_size:
+                run(pending[:self.batch_size])
+                pending = pending[self.batch_size:]
+            while next_doc in docs and docs[next_doc][2] == 0:
+                pieces = docs.pop(next_doc)[1]
+                yield ''.join(pieces[k] for k in sorted(pieces))
+                next_doc += 1
+        if pending:
+            run(pending)
+        while next_doc in docs:
+            pieces = docs.pop(next_doc)[1]
+            yield ''.join(pieces[k] for k in sorted(pieces))
+            next_doc += 1
+
+
+def load_corrector(args):
+    from run import MODEL_CLASSES
+    from checkpointing import load_checkpoint, checkpoint_id
+    from models import TokenFeatureCache
+
+    config_class, model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
+    config = config_class.from_pretrained(args.model_name_or_path)
+    tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
+    model = load_checkpoint(model_class, args.model_name_or_path, config=config)
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    model.to(device)
+    if not args.no_token_feature_cache:
+        model.token_feature_cache = TokenFeatureCache(tokenizer)
+
+    merger = None
+    if args.chaizi_path:
+        index = ChaiziIndex.from_file(args.chaizi_path, vocab=tokenizer.vocab)
+        lm = CharNgramModel.from_files(args.lm_files)
+        merger = SplitMerger(index, lm, margin=args.merge_margin)
+
+    result_cache = None
+    if args.result_cache_size > 0:
+        # Results depend on the weights and on every decoding setting
+        namespace = '|'.join(str(x) for x in (
+            checkpoint_id(args.model_name_or_path), args.model_type, args.max_seq_length, args.max_rounds,
+            args.chaizi_path, args.merge_margin, args.detect_threshold))
+        result_cache = ResultCache(namespace, capacity=args.result_cache_size, ttl=args.result_cache_ttl,
+                                   disk_path=args.result_cache_path)
+    profiler = BranchProfiler(model).start() if args.profile_output else None
+    return Corrector(model, tokenizer, model_class.build_batch, device,
+                     max_seq_length=args.max_seq_length, batch_size=args.batch_size,
+                     merger=merger, detect_threshold=args.detect_threshold, max_rounds=args.max_rounds,
+                     result_cache=result_cache, profiler=profiler)
+
+
+def add_corrector_args(parser):
+    parser.add_argument("--model_type", default=None, type=str, required=True)
+    parser.add_argument("--model_name_or_path", default=None, type=str, required=True,
+                        help="Trained checkpoint directory (config, vocab and weights)")
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--no_cuda", action='store_true')
+    parser.add_argument("--chaizi_path", default='', type=str,
+                        help="Chaizi file; enables the rule stage for splitting errors")
+    parser.add_argument("--lm_files", nargs='*', default=['data/News/tgt.train.txt', 'data/Social/tgt.train.txt'],
+                        help="Clean text the character n-gram model is estimated on")
+    parser.add_argument("--merge_margin", default=2.0, type=float,
+                        help="Log-probability gain above which a merge is applied without the model")
+    parser.add_argument("--detect_threshold", default=None, type=float,
+                        help="Send only the sentences with an n-gram transition log-probability below this "
+                             "(or an ambiguous merge) to the model; by default every sentence goes to the model")
+    parser.add_argument("--max_rounds", default=1, type=int,
+                        help="Correction rounds; sentences changed in a round are corrected again")
+    parser.add_argument("--no_token_feature_cache", action='store_true',
+                        help="Recompute the per-character pho/wubi/glyph features for every sentence")
+    parser.add_argument("--result_cache_size", default=100000, type=int,
+                        help="Sentences kept in the in-memory result cache, 0 disables the cache")
+    parser.add_argument("--result_cache_ttl", default=None, type=float,
+                        help="Seconds after which a cached result expires")
+    parser.add_argument("--result_cache_path", default='', type=str,
+                        help="Sqlite file backing the result cache, shared across runs")
+    parser.add_argument("--profile_output", default='', type=str,
+                        help="Profile every model call per branch and write the trace and summary to this JSON file")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_corrector_args(parser)
+    parser.add_argument("--input_file", required=True, type=str)
+    parser.add_argument("--output_file", required=True, type=str)
+    parser.add_argument("--document_mode", action='store_true',
+                        help="Every input line is a document of any length, corrected in overlapping windows")
+    parser.add_argument("--window_overlap", default=16, type=int,
+                        help="Context characters on each side of a window in document mode")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    corrector = load_corrector(args)
+    if args.document_mode:
+        with open(args.input_file, 'r', encoding='utf-8') as f, open(args.output_file, 'w', encoding='utf-8') as out:
+            for document in corrector.correct_documents((line.rstrip('\n') for line in f), overlap=args.window_overlap):
+                out.write(document + '\n')
+                out.flush()
+    else:
+        with open(args.input_file, 'r', encoding='utf-8') as f:
+            sentences = [line.strip() for line in f]
+        corrected = corrector.correct(sentences)
+        with open(args.output_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(corrected) + '\n')
+    logger.info("Correction stats: %s", dict(corrector.stats))
+    if corrector.result_cache is not None:
+        logger.info("Result cache hit rate: %.4f %s", corrector.result_cache.hit_rate(), dict(corrector.result_cache.stats))
+    if corrector.profiler is not None:
+        corrector.profiler.stop()
+        corrector.profiler.log_summary()
+        corrector.profiler.dump(args.profile_output)
@@ -0,0 +1,126 @@
+'''Edit tags for spelling and splitting corrections.
+
+Targets aligned by process_src_tgt_to_equal_len mark a split character with '#' followed by the
+merged character (src 女口果 -> tgt #如果). As edit tags this becomes one prediction per correction:
+
+    KEEP        copy the source character
+    REPLACE(c)  replace the source character with c
+    MERGE(c)    merge the source character with the next one into c (the next one is consumed)
+'''
+
+import numpy as np
+import torch
+
+
+KEEP, REPLACE, MERGE = 0, 1, 2
+NUM_EDIT_TAGS = 3
+IGNORE_INDEX = -100
+
+
+def build_edit_labels(src_idx, tgt_idx, loss_mask, merge_id):
+    '''
+    Tensors [B, S] -> (edit_labels, char_labels). Positions outside the loss mask and positions
+    consumed by a merge get IGNORE_INDEX.
+    '''
+    active = loss_mask == 1
+    merge = (tgt_idx == merge_id) & active
+    next_tgt = torch.cat((tgt_idx[:, 1:], tgt_idx[:, -1:]), dim=1)
+    consumed = torch.cat((torch.zeros_like(merge[:, :1]), merge[:, :-1]), dim=1)
+
+    edit_labels = (src_idx != tgt_idx).long() * REPLACE
+    edit_labels = torch.where(merge, torch.full_like(edit_labels, MERGE), edit_labels)
+    char_labels = torch.where(merge, next_tgt, tgt_idx)
+
+    ignore = ~active | consumed
+    edit_labels = edit_labels.masked_fill(ignore, IGNORE_INDEX)
+    char_labels = char_labels.masked_fill(ignore, IGNORE_INDEX)
+    return edit_labels, char_labels
+
+
+def _resolve_merges(edit_preds, lengths):
+    '''Merges that can be applied: inside the sentence, with a next character, and leftmost first in a run.'''
+    B, S = edit_preds.shape
+    positions = np.arange(S)[None, :]
+    lengths = np.asarray(lengths)[:, None]
+    merge = (edit_preds == MERGE) & (positions >= 1) & (positions < lengths)
+    prev = np.concatenate((np.zeros((B, 1), dtype=bool), merge[:, :-1]), axis=1)
+    run_start = np.maximum.accumulate(np.where(merge & ~prev, positions, 0), axis=1)
+    return merge & ((positions - run_start) % 2 == 0)
+
+
+def merge_decode(src_idx, edit_preds, char_preds, lengths, merge_id):
+    '''
+    Arrays [B, S] (position 0 is [CLS], the sentence is 1..length) -> (outputs, aligned).
+    outputs are the corrected id sequences without [CLS]/[SEP], shorter by one per merge;
+    aligned is the '#'-aligned [B, S] form used by the label files.
+    '''
+    src_idx, edit_preds, char_preds = np.asarray(src_idx), np.asarray(edit_preds), np.asarray(char_preds)
+    B, S = src_idx.shape
+    merge = _resolve_merges(edit_preds, lengths)
+    consumed = np.concatenate((np.zeros((B, 1), dtype=bool), merge[:, :-1]), axis=1)
+    replace = (edit_preds == REPLACE) & ~merge & ~consumed
+
+    aligned = np.where(replace, char_preds, src_idx)
+    aligned = np.where(merge, merge_id, aligned)
+    merged_chars = np.concatenate((np.zeros((B, 1), dtype=char_preds.dtype), char_preds[:, :-1]), axis=1)
+    aligned = np.where(consumed, merged_chars, aligned)
+
+    token = np.where(merge, char_preds, np.where(replace, char_preds, src_idx))
+    outputs = []
+    for i, length in enumerate(lengths):
+        keep = ~consumed[i, 1:length + 1]
+        outputs.append(token[i, 1:length + 1][keep].tolist())
+    return outputs, aligned
+
+
+def _edits(src_idx, aligned, lengths, merge_id):
+    '''(rows, positions, types, chars) of every edit in '#'-aligned sequences.'''
+    src_idx, aligned = np.asarray(src_idx), np.asarray(aligned)
+    positions = np.arange(src_idx.shape[1])[None, :]
+    active = (positions >= 1) & (positions <= np.asarray(lengths)[:, None])
+    merge = (aligned == merge_id) & active
+    next_aligned = np.concatenate((aligned[:, 1:], aligned[:, -1:]), axis=1)
+    consumed = np.concatenate((np.zeros_like(merge[:, :1]), merge[:, :-1]), axis=1)
+    replace = (aligned != src_idx) & active & ~merge & ~consumed
+    rows, cols = np.nonzero(merge | replace)
+    types = np.where(merge[rows, cols], MERGE, REPLACE)
+    chars = np.where(merge[rows, cols], next_aligned[rows, cols], aligned[rows, cols])
+    return rows, cols, types, chars
+
+
+def _prf(tp, n_pred, n_gold):
+    p = tp / n_pred if n_pred > 0 else 0.0
+    r = tp / n_gold if n_gold > 0 else 0.0
+    f = 2 * p * r / (p + r) if p + r > 0 else 0.0
+    return float(p), float(r), float(f)
+
+
+def edit_metrics(src_idx, pred_aligned, gold_aligned, lengths, merge_id):
+    '''
+    Edit-level and sentence-level P/R/F for '#'-aligned predictions, where a merge counts as one edit.
+    Detection matches (position, type), correction also the character.
+    '''
+    pred = _edits(src_idx, pred_aligned, lengths, merge_id)
+    gold = _edits(src_idx, gold_aligned, lengths, merge_id)
+    n_rows = np.asarray(src_idx).shape[0]
+
+    def keys(edits, with_char):
+        rows, cols, types, chars = edits
+        k = (rows.astype(np.int64) * 1024 + cols) * 4 + types
+        return k * (1 << 20) + chars if with_char else k
+
+    results = {}
+    for name, with_char in (('det', False), ('cor', True)):
+        pred_keys, gold_keys = keys(pred, with_char), keys(gold, with_char)
+        hit = np.isin(pred_keys, gold_keys)
+        p, r, f = _prf(hit.sum(), len(pred_keys), len(gold_keys))
+        results['edit_%s_p' % name], results['edit_%s_r' % name], results['edit_%s_f' % name] = p, r, f
+
+        # Sentence level: a sentence with predicted edits is right if its edits equal the gold ones
+        pred_count = np.bincount(pred[0], minlength=n_rows)
+        gold_count = np.bincount(gold[0], minlength=n_rows)
+        hit_count = np.bincount(pred[0][hit], minlength=n_rows)
+        correct = (pred_count > 0) & (pred_count == gold_count) & (hit_count == pred_count)
+        p, r, f = _prf(correct.sum(), (pred_count > 0).sum(), (gold_count > 0).sum())
+        results['edit_sent_%s_p' % name], results['edit_sent_%s_r' % name], results['edit_sent_%s_f' % name] = p, r, f
+    return results
@@ -3,19 +3,32 @@ import logging
 import math
 import os
 import sys
+from contextlib import nullcontext
 
-import opencc
 import torch
+import torch.utils.checkpoint
 from torch import nn
 from torch.nn import CrossEntropyLoss, MSELoss
 
 from transformers.modeling_bert import *
 from utils import pho_convertor, pho2_convertor, pos_convertor, wubi_convertor
 from copy import deepcopy
-from PIL import ImageFont
+from inspect import signature
 import numpy as np
 
 from char_cnn import CharResNet, CharResNet1
+from edit_tags import build_edit_labels, NUM_EDIT_TAGS, IGNORE_INDEX
+
+logger = logging.getLogger(__name__)
+
+# PIL and opencc are only needed to render glyphs, imported when that happens
+def _image_font():
+    from PIL import ImageFont
+    return ImageFont
+
+def _opencc():
+    import opencc
+    return opencc
 
 def _is_chinese_char(cp):
     if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
@@ -29,6 +42,402 @@ def _is_chinese_char(cp):
         return True
     return False
 
+# Non-reentrant checkpointing also recomputes modules whose inputs do not require grad (e.g. the resnet on glyph images).
+_CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in signature(torch.utils.checkpoint.checkpoint).parameters else {}
+
+CHECKPOINT_BRANCHES = ('bert', 'pho_model', 'wubi_model', 'output_block', 'resnet', 'hiddens_gru')
+# Reentrant checkpointing (torch without use_reentrant) drops the graph of these: the resnet's glyph
+# images do not require grad, and hiddens_gru gets a PackedSequence it does not see as a tensor
+_REENTRANT_UNSAFE_BRANCHES = ('resnet', 'hiddens_gru')
+
+def _checkpointed_forward(forward):
+    def wrapped(*inputs):
+        if torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(forward, *inputs, **_CHECKPOINT_KWARGS)
+        return forward(*inputs)
+    return wrapped
+
+def enable_gradient_checkpointing(model, branches=CHECKPOINT_BRANCHES):
+    '''
+    Recompute activations in the backward pass instead of storing them.
+    BertModel branches are checkpointed layer by layer, other branches as a whole.
+    Returns the names of the branches that were found on the model; the ones that cannot be
+    checkpointed with this torch are skipped.
+    '''
+    enabled = []
+    for name in branches:
+        module = getattr(model, name, None)
+        if module is None:
+            continue
+        if not _CHECKPOINT_KWARGS and name in _REENTRANT_UNSAFE_BRANCHES:
+            logger.warning("Not checkpointing %s: this torch only has reentrant checkpointing, "
+                           "which would stop its gradients", name)
+            continue
+        if isinstance(module, BertModel):
+            for layer in module.encoder.layer:
+                layer.forward = _checkpointed_forward(layer.forward)
+        else:
+            module.forward = _checkpointed_forward(module.forward)
+        enabled.append(name)
+    return enabled
+
+# Modules making up each modality branch. The spelling GRUs and the resnet (with its layernorm)
+# only see one token at a time, so their outputs can be tabulated per vocab id.
+BRANCH_MODULES = {
+    'pho': ('pho_embeddings', 'pho_gru', 'pho_model'),
+    'wubi': ('wubi_embeddings', 'wubi_gru', 'wubi_model'),
+    'res': ('resnet', 'resnet_layernorm'),
+}
+
+def _eval_only(module):
+    def train(mode=True):
+        return nn.Module.train(module, False)
+    return train
+
+def freeze_branches(model, branches):
+    '''
+    Freeze the given modality branches: their parameters stop requiring grad,
+    they always run in eval mode and their forward is done under no_grad.
+    '''
+    frozen = []
+    for branch in branches:
+        modules = [getattr(model, name, None) for name in BRANCH_MODULES[branch]]
+        modules = [m for m in modules if m is not None]
+        if len(modules) == 0:
+            continue
+        for module in modules:
+            for p in module.parameters():
+                p.requires_grad = False
+            for m in module.modules():
+                m.train = _eval_only(m)
+            module.eval()
+        frozen.append(branch)
+    model.frozen_branches = set(getattr(model, 'frozen_branches', ())) | set(frozen)
+    return frozen
+
+def _branch_context(model, branch):
+    return torch.no_grad() if branch in getattr(model, 'frozen_branches', ()) else nullcontext()
+
+def _segment_layout(batch):
+    '''
+    For packed rows (segment_ids numbered 1..k per row, 0 on padding): the sentence index of
+    every real token over the whole batch, its offset in the sentence, the mask of real tokens
+    and the sentence lengths.
+    '''
+    segment_ids = batch['segment_ids']
+    valid = segment_ids > 0
+    num_segments = segment_ids.max(dim=1)[0]
+    offsets = torch.cumsum(num_segments, dim=0) - num_segments
+    sentence_idx = (offsets.unsqueeze(1) + segment_ids - 1)[valid]
+    return sentence_idx, batch['position_ids'][valid], valid, torch.bincount(sentence_idx)
+
+def _attention_mask(batch):
+    '''[B, S] mask, or for packed rows a block-diagonal [B, S, S] mask keeping attention inside each sentence.'''
+    if 'segment_ids' not in batch:
+        return batch['masks']
+    segment_ids = batch['segment_ids']
+    return ((segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)) & (segment_ids.unsqueeze(1) > 0)).long()
+
+def _sentence_mean(hiddens, batch):
+    '''Mean of the hiddens over each sentence, broadcast back to its tokens.'''
+    if 'segment_ids' not in batch:
+        attention_mask = batch['masks'].to(torch.float).unsqueeze(2)
+        mean = (hiddens * attention_mask).sum(dim=1) / attention_mask.sum(dim=1)
+        return mean.unsqueeze(1).expand(-1, hiddens.size(1), -1)
+    sentence_idx, _, valid, lengths = _segment_layout(batch)
+    sums = hiddens.new_zeros(lengths.numel(), hiddens.size(-1)).index_add_(0, sentence_idx, hiddens[valid])
+    means = sums / lengths.unsqueeze(1).to(hiddens.dtype)
+    result = hiddens.new_zeros(hiddens.shape)
+    result[valid] = means[sentence_idx]
+    return result
+
+def _sentence_gru(gru, hiddens, batch):
+    '''Run gru over every row, or for packed rows over every sentence separately.'''
+    if 'segment_ids' not in batch:
+        return gru(hiddens)[0]
+    sentence_idx, positions, valid, lengths = _segment_layout(batch)
+    sentences = hiddens.new_zeros(lengths.numel(), int(lengths.max()), hiddens.size(-1))
+    sentences[sentence_idx, positions] = hiddens[valid]
+    packed = torch.nn.utils.rnn.pack_padded_sequence(sentences, lengths.cpu(), batch_first=True, enforce_sorted=False)
+    outputs = torch.nn.utils.rnn.pad_packed_sequence(gru(packed)[0], batch_first=True, total_length=sentences.size(1))[0]
+    result = outputs.new_zeros(hiddens.size(0), hiddens.size(1), outputs.size(-1))
+    result[valid] = outputs[sentence_idx, positions]
+    return result
+
+def chunked_cross_entropy(classifier, hiddens, labels, chunk_size=1024, ignore_index=-100, reduction='mean'):
+    '''
+    Mean cross entropy of classifier(hiddens) [N, V] against labels [N], chunk_size rows at a time.
+    With grad enabled every chunk is checkpointed, so only one chunk of logits is alive at a time.
+    reduction='none' returns the [N] per-row losses instead (0 on ignore_index).
+    '''
+    def chunk_loss(chunk_hiddens, chunk_labels):
+        return torch.nn.functional.cross_entropy(classifier(chunk_hiddens), chunk_labels,
+                                                 ignore_index=ignore_index, reduction='sum' if reduction == 'mean' else 'none')
+    losses = []
+    for start in range(0, hiddens.size(0), chunk_size):
+        chunk_hiddens, chunk_labels = hiddens[start:start+chunk_size], labels[start:start+chunk_size]
+        if torch.is_grad_enabled() and chunk_hiddens.requires_grad:
+            losses.append(torch.utils.checkpoint.checkpoint(chunk_loss, chunk_hiddens, chunk_labels, **_CHECKPOINT_KWARGS).float())
+        else:
+            losses.append(chunk_loss(chunk_hiddens, chunk_labels).float())
+    if reduction == 'none':
+        return torch.cat(losses) if losses else hiddens.new_zeros(0, dtype=torch.float)
+    total = sum(losses, hiddens.new_zeros((), dtype=torch.float))
+    return total / (labels != ignore_index).sum().clamp(min=1)
+
+def example_losses(token_losses, batch, active):
+    '''
+    Mean of token_losses (one per active position) over every sentence of the batch, in row-major
+    order; a packed row holds several sentences, told apart by segment_ids.
+    '''
+    segments = batch['segment_ids'] if 'segment_ids' in batch else batch['masks']
+    B, S = segments.shape
+    slots = (torch.arange(B, device=segments.device).unsqueeze(1) * S + segments).view(-1)
+    totals = token_losses.new_zeros(B * S).index_add_(0, slots[active], token_losses)
+    counts = token_losses.new_zeros(B * S).index_add_(0, slots[active], torch.ones_like(token_losses))
+    present = torch.bincount(slots[segments.view(-1) > 0], minlength=B * S) > 0
+    return (totals / counts.clamp(min=1))[present]
+
+class ContrastiveLoss(nn.Module):
+    '''
+    Contrastive objectives computed on device, without loops over negatives or host syncs.
+
+    token(logits, labels): the hard negatives of each row are its num_negatives highest scoring
+    wrong classes (the gold class is masked out). 'margin' averages relu(negative - positive),
+    'infonce' is the cross entropy of the positive against them at the given temperature.
+
+    in_batch(anchors, candidates): InfoNCE over cosine similarities, candidates[i] being the positive
+    of anchors[i] and the other candidates its negatives; with num_negatives only the hardest are kept.
+    '''
+    def __init__(self, num_negatives=5, temperature=1.0, mode='margin'):
+        super(ContrastiveLoss, self).__init__()
+        if mode not in ('margin', 'infonce'):
+            raise ValueError('invalid contrastive mode %s' % mode)
+        self.num_negatives = num_negatives
+        self.temperature = temperature
+        self.mode = mode
+
+    def _infonce(self, positives, negatives):
+        scores = torch.cat((positives, negatives), dim=1) / self.temperature
+        return torch.nn.functional.cross_entropy(scores, scores.new_zeros(scores.size(0), dtype=torch.long))
+
+    def token(self, logits, labels):
+        if logits.size(0) == 0:
+            return logits.sum() * 0
+        labels = labels.unsqueeze(1)
+        positives = logits.gather(1, labels)
+        masked = logits.scatter(1, labels, torch.finfo(logits.dtype).min)
+        negatives = masked.topk(min(self.num_negatives, logits.size(1) - 1), dim=1)[0]
+        if self.mode == 'margin':
+            return torch.relu(negatives - positives).mean()
+        return self._infonce(positives, negatives)
+
+    def in_batch(self, anchors, candidates):
+        anchors = torch.nn.functional.normalize(anchors, dim=-1)
+        candidates = torch.nn.functional.normalize(candidates, dim=-1)
+        similarity = torch.matmul(anchors, candidates.transpose(0, 1))
+        batch_size = similarity.size(0)
+        if self.num_negatives is None or self.num_negatives >= batch_size - 1:
+            targets = torch.arange(batch_size, device=similarity.device)
+            return torch.nn.functional.cross_entropy(similarity / self.temperature, targets)
+        diagonal = torch.eye(batch_size, dtype=torch.bool, device=similarity.device)
+        negatives = similarity.masked_fill(diagonal, torch.finfo(similarity.dtype).min).topk(self.num_negatives, dim=1)[0]
+        return self._infonce(similarity.diagonal().unsqueeze(1), negatives)
+
+def contrastive_loss_from_config(config, num_negatives, temperature, mode='margin'):
+    '''ContrastiveLoss with the defaults of a model, overridden by contrastive_* attributes of the config.'''
+    return ContrastiveLoss(num_negatives=getattr(config, 'contrastive_negatives', None) or num_negatives,
+                           temperature=getattr(config, 'contrastive_temperature', None) or temperature,
+                           mode=getattr(config, 'contrastive_mode', None) or mode)
+
+def _spell_gru_hiddens(embeddings, gru, spell_idx, spell_lens):
+    spell_embeddings = embeddings(spell_idx)
+    spell_embeddings = torch.nn.utils.rnn.pack_padded_sequence(
+        input=spell_embeddings,
+        lengths=spell_lens,
+        batch_first=True,
+        enforce_sorted=False,
+    )
+    _, hiddens = gru(spell_embeddings)
+    return hiddens.squeeze(0)
+
+def build_unique_batch(batch, tokenizer, wubi=False):
+    '''
+    build_batch for models using the branch helpers below: pho (and wubi) sequences are built
+    for the distinct ids of the batch only, unique_idx / inverse_idx map them back to positions.
+    '''
+    unique_idx, inverse_idx = torch.unique(batch['src_idx'], return_inverse=True)
+    chars = tokenizer.convert_ids_to_tokens(unique_idx.tolist())
+    batch['unique_idx'] = unique_idx
+    batch['inverse_idx'] = inverse_idx
+    batch['pho_idx'], batch['pho_lens'] = pho2_convertor.convert(chars)
+    if wubi:
+        batch['wubi_idx'], batch['wubi_lens'] = wubi_convertor.convert(chars)
+    return batch
+
+def _scatter_back(hiddens, batch):
+    '''Per-token outputs -> [B, S, H]; with unique_idx they are per distinct id and gathered back.'''
+    input_ids = batch['src_idx']
+    if 'inverse_idx' in batch:
+        return hiddens[batch['inverse_idx']]
+    return hiddens.reshape(input_ids.shape[0], input_ids.shape[1], -1).contiguous()
+
+class GlyphTable(nn.Module):
+    '''
+    Rendered glyphs of the vocab, [V, num_fonts, 32, 32], kept as the uint8 font masks and
+    normalized per font with the stored mean and std only for the ids looked up. Called with ids
+    it returns [N, num_fonts * 32 * 32] like the nn.Embedding it replaces; index_select gives images.
+    The glyphs are non-persistent buffers: they follow .to() / .half() (and apex amp) like the
+    rest of the model but are not in the state dict (see checkpointing's glyph cache).
+    '''
+    def __init__(self, num_chars, num_fonts=1, size=32):
+        super(GlyphTable, self).__init__()
+        self.register_buffer('images', torch.zeros(num_chars, num_fonts, size, size, dtype=torch.uint8), persistent=False)
+        self.register_buffer('mean', torch.zeros(num_fonts), persistent=False)
+        self.register_buffer('std', torch.ones(num_fonts), persistent=False)
+
+    def set_images(self, images):
+        '''images: font masks (values 0..255), [V, size, size] for one font or [V, num_fonts, size, size].'''
+        images = torch.as_tensor(images).reshape(self.images.shape).double()
+        self.mean = images.mean(dim=(0, 2, 3)).to(self.mean)
+        self.std = images.std(dim=(0, 2, 3), unbiased=False).to(self.std)
+        self.images = images.round().clamp(0, 255).to(device=self.images.device, dtype=torch.uint8)
+
+    def set_normalized(self, images):
+        '''
+        images: glyphs already normalized like the float glyphs of older checkpoints, [V, size * size]
+        or [V, num_fonts, size, size]. Per font the blank pixels (0) are the lowest value and the full
+        ones (255) the highest, which gives back the masks and the mean and std they were normalized with.
+        '''
+        images = torch.as_tensor(images).reshape(self.images.shape).double()
+        values = images.transpose(0, 1).reshape(images.shape[1], -1)
+        low, high = values.min(dim=1)[0], values.max(dim=1)[0]
+        scale = 255.0 / (high - low).clamp(min=1e-12)
+        masks = (images - low.view(1, -1, 1, 1)) * scale.view(1, -1, 1, 1)
+        self.mean = (-low * scale).to(self.mean)
+        self.std = scale.to(self.std)
+        self.images = masks.round().clamp(0, 255).to(device=self.images.device, dtype=torch.uint8)
+
+    def glyph_state(self):
+        return {'images': self.images.cpu(), 'mean': self.mean.cpu(), 'std': self.std.cpu()}
+
+    def load_glyph_state(self, state):
+        device = self.images.device
+        self.images = state['images'].to(device)
+        self.mean = state['mean'].to(self.mean)
+        self.std = state['std'].to(self.std)
+
+    def index_select(self, dim, index):
+        images = self.images.index_select(dim, index).to(self.mean.dtype)
+        return (images - self.mean.view(1, -1, 1, 1)) / self.std.view(1, -1, 1, 1)
+
+    def forward(self, ids):
+        return self.index_select(0, ids.reshape(-1)).reshape(ids.shape + (-1,))
+
+def _glyph_images(model, src_idxs):
+    if model.config.num_fonts == 1:
+        return model.char_images(src_idxs).reshape(src_idxs.shape[0], 1, 32, 32).contiguous()
+    return model.char_images_multifonts.index_select(dim=0, index=src_idxs)
+
+def _token_features(model, branch, ids, chars):
+    '''Per-token part of a branch for 1-D ids and their characters, [N, H].'''
+    with _branch_context(model, branch):
+        if branch == 'pho':
+            pho_idx, pho_lens = pho2_convertor.convert(chars)
+            return _spell_gru_hiddens(model.pho_embeddings, model.pho_gru, pho_idx.to(ids.device), pho_lens)
+        if branch == 'wubi':
+            wubi_idx, wubi_lens = wubi_convertor.convert(chars)
+            return _spell_gru_hiddens(model.wubi_embeddings, model.wubi_gru, wubi_idx.to(ids.device), wubi_lens)
+        return model.resnet_layernorm(model.resnet(_glyph_images(model, ids)))
+
+class TokenFeatureCache(object):
+    '''
+    Inference-time memo of the per-token branch features (pho_gru, wubi_gru, resnet) by vocab id.
+    Only ids not seen before are run through the branch, so re-encoding a corrected sentence
+    computes these features for the changed characters only.
+    '''
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.tables = {}
+        self.filled = {}
+        self.computed = 0
+        self.looked_up = 0
+
+    def lookup(self, model, branch, input_ids):
+        ids = input_ids.unique()
+        if branch not in self.filled:
+            self.filled[branch] = torch.zeros(model.config.vocab_size, dtype=torch.bool, device=ids.device)
+        missing = ids[~self.filled[branch][ids]]
+        if missing.numel() > 0:
+            features = _token_features(model, branch, missing, self.tokenizer.convert_ids_to_tokens(missing.tolist()))
+            if branch not in self.tables:
+                self.tables[branch] = features.new_zeros(model.config.vocab_size, features.shape[-1])
+            self.tables[branch][missing] = features
+            self.filled[branch][missing] = True
+            self.computed += missing.numel()
+        self.looked_up += ids.numel()
+        return self.tables[branch][input_ids]
+
+    def clear(self):
+        self.tables, self.filled = {}, {}
+
+def _token_table(model, branch, input_ids):
+    table = getattr(model, '%s_table' % branch, None)
+    if table is not None:
+        return table[input_ids]
+    cache = getattr(model, 'token_feature_cache', None)
+    if cache is not None and not torch.is_grad_enabled():
+        return cache.lookup(model, branch, input_ids)
+    return None
+
+def _pho_gru_hiddens(model, batch):
+    input_ids = batch['src_idx']
+    hiddens = _token_table(model, 'pho', input_ids)
+    if hiddens is not None:
+        return hiddens
+    with _branch_context(model, 'pho'):
+        hiddens = _spell_gru_hiddens(model.pho_embeddings, model.pho_gru, batch['pho_idx'], batch['pho_lens'])
+    return _scatter_back(hiddens, batch)
+
+def _wubi_gru_hiddens(model, batch):
+    input_ids = batch['src_idx']
+    hiddens = _token_table(model, 'wubi', input_ids)
+    if hiddens is not None:
+        return hiddens
+    with _branch_context(model, 'wubi'):
+        hiddens = _spell_gru_hiddens(model.wubi_embeddings, model.wubi_gru, batch['wubi_idx'], batch['wubi_lens'])
+    return _scatter_back(hiddens, batch)
+
+def _res_hiddens(model, batch):
+    input_ids = batch['src_idx']
+    hiddens = _token_table(model, 'res', input_ids)
+    if hiddens is not None:
+        return hiddens
+    with _branch_context(model, 'res'):
+        ids = batch['unique_idx'] if 'unique_idx' in batch else input_ids.view(-1)
+        hiddens = _scatter_back(model.resnet_layernorm(model.resnet(_glyph_images(model, ids))), batch)
+    return hiddens
+
+def build_branch_cache(model, tokenizer, branches, batch_size=1024):
+    '''
+    Tabulate the per-token part of frozen branches (pho_gru, wubi_gru, resnet) for the whole vocab.
+    The tables are non-persistent buffers, so they are not written into checkpoints.
+    '''
+    device = next(model.parameters()).device
+    chars = tokenizer.convert_ids_to_tokens(list(range(model.config.vocab_size)))
+    cached = []
+    for branch in branches:
+        if branch not in getattr(model, 'frozen_branches', ()):
+            raise ValueError('only frozen branches can be cached, got %s' % branch)
+        tables = []
+        for start in range(0, len(chars), batch_size):
+            sub_chars = chars[start:start+batch_size]
+            ids = torch.arange(start, start+len(sub_chars), dtype=torch.long, device=device)
+            tables.append(_token_features(model, branch, ids, sub_chars))
+        model.register_buffer('%s_table' % branch, torch.cat(tables, dim=0), persistent=False)
+        cached.append(branch)
+    return cached
+
 class SpellBert(BertPreTrainedModel):
     def __init__(self, config):
         super(SpellBert, self).__init__(config)
@@ -255,8 +664,7 @@ class SpellBertPho1Res(BertPreTrainedModel):
         self.vocab_size = config.vocab_size
         self.bert = BertModel(config)
 
-        self.char_images = nn.Embedding(config.vocab_size, 1024)
-        self.char_images.weight.requires_grad = False
+        self.char_images = GlyphTable(config.vocab_size)
 
         self.pho_embeddings = nn.Embedding(pho_convertor.get_pho_size(), config.hidden_size, padding_idx=0)
         self.resnet = CharResNet()
@@ -282,7 +690,7 @@ class SpellBertPho1Res(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -305,10 +713,8 @@ class SpellBertPho1Res(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     @staticmethod
     def build_batch(batch, tokenizer):
@@ -386,8 +792,7 @@ class SpellBertPho2Res(BertPreTrainedModel):
         self.vocab_size = config.vocab_size
         self.bert = BertModel(config)
 
-        self.char_images = nn.Embedding(config.vocab_size, 1024)
-        self.char_images.weight.requires_grad = False
+        self.char_images = GlyphTable(config.vocab_size)
 
         self.pho_embeddings = nn.Embedding(pho2_convertor.get_pho_size(), config.hidden_size, padding_idx=0)
         self.pho_gru = nn.GRU(
@@ -421,7 +826,7 @@ class SpellBertPho2Res(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -444,10 +849,8 @@ class SpellBertPho2Res(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     @staticmethod
     def build_batch(batch, tokenizer):
@@ -530,8 +933,7 @@ class SpellBertPho2ResArch2(BertPreTrainedModel):
         pho_config.num_hidden_layers = 4
         self.pho_model = BertModel(pho_config)
 
-        self.char_images = nn.Embedding(config.vocab_size, 1024)
-        self.char_images.weight.requires_grad = False
+        self.char_images = GlyphTable(config.vocab_size)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet()
@@ -559,7 +961,7 @@ class SpellBertPho2ResArch2(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -582,10 +984,8 @@ class SpellBertPho2ResArch2(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     @staticmethod
     def build_batch(batch, tokenizer):
@@ -672,11 +1072,9 @@ class SpellBertPho2ResArch3(BertPreTrainedModel):
         self.pho_model = BertModel(pho_config)
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -705,7 +1103,7 @@ class SpellBertPho2ResArch3(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -728,10 +1126,8 @@ class SpellBertPho2ResArch3(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -744,7 +1140,7 @@ class SpellBertPho2ResArch3(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('/home/wtl/research/ReaLiSe/simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -757,7 +1153,7 @@ class SpellBertPho2ResArch3(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -767,7 +1163,7 @@ class SpellBertPho2ResArch3(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -789,53 +1185,29 @@ class SpellBertPho2ResArch3(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
     def build_batch(batch, tokenizer):
-        src_idx = batch['src_idx'].flatten().tolist()
-        chars = tokenizer.convert_ids_to_tokens(src_idx)
-        pho_idx, pho_lens = pho2_convertor.convert(chars)
-        batch['pho_idx'] = pho_idx
-        batch['pho_lens'] = pho_lens
-        return batch
+        return build_unique_batch(batch, tokenizer)
 
     def forward(self, batch):
         input_ids = batch['src_idx']
         attention_mask = batch['masks']
         loss_mask = batch['loss_masks']
-        pho_idx = batch['pho_idx']
-        pho_lens = batch['pho_lens']
         label_ids = batch['tgt_idx'] if 'tgt_idx' in batch else None
 
         input_shape = input_ids.size()
 
         bert_hiddens = self.bert(input_ids, attention_mask=attention_mask)[0]
         
-        pho_embeddings = self.pho_embeddings(pho_idx)
-        pho_embeddings = torch.nn.utils.rnn.pack_padded_sequence(
-            input=pho_embeddings,
-            lengths=pho_lens,
-            batch_first=True,
-            enforce_sorted=False,
-        )
-        _, pho_hiddens = self.pho_gru(pho_embeddings)
-        pho_hiddens = pho_hiddens.squeeze(0).reshape(input_shape[0], input_shape[1], -1).contiguous()
-        pho_hiddens = self.pho_model(inputs_embeds=pho_hiddens, attention_mask=attention_mask)[0]
-
-        src_idxs = input_ids.view(-1)
-
-        if self.config.num_fonts == 1:
-            images = self.char_images(src_idxs).reshape(src_idxs.shape[0], 1, 32, 32).contiguous()
-        else:
-            images = self.char_images_multifonts.index_select(dim=0, index=src_idxs)
+        pho_hiddens = _pho_gru_hiddens(self, batch)
+        with _branch_context(self, 'pho'):
+            pho_hiddens = self.pho_model(inputs_embeds=pho_hiddens, attention_mask=attention_mask)[0]
 
-        res_hiddens = self.resnet(images)
-        res_hiddens = res_hiddens.reshape(input_shape[0], input_shape[1], -1).contiguous()
-        res_hiddens = self.resnet_layernorm(res_hiddens)
+        res_hiddens = _res_hiddens(self, batch)
 
         bert_hiddens_mean = (bert_hiddens * attention_mask.to(torch.float).unsqueeze(2)).sum(dim=1) / attention_mask.to(torch.float).sum(dim=1, keepdim=True)
         bert_hiddens_mean = bert_hiddens_mean.unsqueeze(1).expand(-1, bert_hiddens.size(1), -1)
@@ -891,8 +1263,7 @@ class SpellBertPho2ResArch3MLM(BertPreTrainedModel):
         pho_config.num_hidden_layers = 4
         self.pho_model = BertModel(pho_config)
 
-        self.char_images = nn.Embedding(config.vocab_size, 1024)
-        self.char_images.weight.requires_grad = False
+        self.char_images = GlyphTable(config.vocab_size)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet()
@@ -921,7 +1292,7 @@ class SpellBertPho2ResArch3MLM(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -944,10 +1315,8 @@ class SpellBertPho2ResArch3MLM(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     @staticmethod
     def build_batch(batch, tokenizer):
@@ -1040,8 +1409,7 @@ class SpellBertPho2ResArch4(BertPreTrainedModel):
         pho_config.num_hidden_layers = 4
         self.pho_model = BertModel(pho_config)
 
-        self.char_images = nn.Embedding(config.vocab_size, 1024)
-        self.char_images.weight.requires_grad = False
+        self.char_images = GlyphTable(config.vocab_size)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet()
@@ -1070,7 +1438,7 @@ class SpellBertPho2ResArch4(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -1093,10 +1461,8 @@ class SpellBertPho2ResArch4(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     @staticmethod
     def build_batch(batch, tokenizer):
@@ -1203,11 +1569,9 @@ class SpellBertPho2ResArch5(BertPreTrainedModel):
         self.pic_model = BertModel(pic_config)
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -1236,7 +1600,7 @@ class SpellBertPho2ResArch5(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -1259,10 +1623,8 @@ class SpellBertPho2ResArch5(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -1275,7 +1637,7 @@ class SpellBertPho2ResArch5(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('/home/jhliang/Research/ReaLiSe/simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -1288,7 +1650,7 @@ class SpellBertPho2ResArch5(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -1298,7 +1660,7 @@ class SpellBertPho2ResArch5(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -1320,9 +1682,8 @@ class SpellBertPho2ResArch5(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
@@ -1416,8 +1777,7 @@ class Pho2ResPretrain(BertPreTrainedModel):
 
         self.vocab_size = config.vocab_size
 
-        self.char_images = nn.Embedding(config.vocab_size, 1024)
-        self.char_images.weight.requires_grad = False
+        self.char_images = GlyphTable(config.vocab_size)
 
         self.pho_embeddings = nn.Embedding(pho2_convertor.get_pho_size(), config.hidden_size, padding_idx=0)
         self.pho_gru = nn.GRU(
@@ -1442,7 +1802,7 @@ class Pho2ResPretrain(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -1465,10 +1825,8 @@ class Pho2ResPretrain(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     @staticmethod
     def build_batch(batch, tokenizer):
@@ -1657,11 +2015,9 @@ class ResPretrain(BertPreTrainedModel):
         self.vocab_size = config.vocab_size
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -1680,7 +2036,7 @@ class ResPretrain(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -1703,10 +2059,8 @@ class ResPretrain(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -1719,7 +2073,7 @@ class ResPretrain(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -1732,7 +2086,7 @@ class ResPretrain(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -1742,7 +2096,7 @@ class ResPretrain(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -1764,9 +2118,8 @@ class ResPretrain(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
@@ -1827,11 +2180,9 @@ class SpellBertPho2ResArch3Pos(BertPreTrainedModel):
         self.pos_model = BertModel(pos_config)
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -1864,7 +2215,7 @@ class SpellBertPho2ResArch3Pos(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -1887,10 +2238,8 @@ class SpellBertPho2ResArch3Pos(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -1903,7 +2252,7 @@ class SpellBertPho2ResArch3Pos(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('/home/jhliang/Research/ReaLiSe/simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -1916,7 +2265,7 @@ class SpellBertPho2ResArch3Pos(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -1926,7 +2275,7 @@ class SpellBertPho2ResArch3Pos(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -1948,9 +2297,8 @@ class SpellBertPho2ResArch3Pos(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
@@ -2104,11 +2452,9 @@ class SpellBertPho2ResArch3PosLoss(BertPreTrainedModel):
         self.pos_model = BertModel(pos_config)
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -2141,7 +2487,7 @@ class SpellBertPho2ResArch3PosLoss(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -2164,10 +2510,8 @@ class SpellBertPho2ResArch3PosLoss(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -2180,7 +2524,7 @@ class SpellBertPho2ResArch3PosLoss(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('/home/jhliang/Research/ReaLiSe/simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -2193,7 +2537,7 @@ class SpellBertPho2ResArch3PosLoss(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -2203,7 +2547,7 @@ class SpellBertPho2ResArch3PosLoss(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -2225,9 +2569,8 @@ class SpellBertPho2ResArch3PosLoss(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
@@ -2381,11 +2724,9 @@ class SpellBertPho2ResArch6(BertPreTrainedModel):
         self.wubi_model = BertModel(wubi_config)
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -2416,7 +2757,7 @@ class SpellBertPho2ResArch6(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -2439,10 +2780,8 @@ class SpellBertPho2ResArch6(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -2455,7 +2794,7 @@ class SpellBertPho2ResArch6(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('/home/jhliang/Research/ReaLiSe/simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -2468,7 +2807,7 @@ class SpellBertPho2ResArch6(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -2478,7 +2817,7 @@ class SpellBertPho2ResArch6(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -2500,9 +2839,8 @@ class SpellBertPho2ResArch6(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
@@ -2625,11 +2963,9 @@ class SpellBertPho2ResArch3Contrast(BertPreTrainedModel):
         self.pho_model = BertModel(pho_config)
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -2647,6 +2983,7 @@ class SpellBertPho2ResArch3Contrast(BertPreTrainedModel):
 
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.classifier = nn.Linear(config.hidden_size, config.vocab_size)
+        self.contrastive_loss = contrastive_loss_from_config(config, num_negatives=5, temperature=0.9)
 
         self.init_weights()
 
@@ -2658,7 +2995,7 @@ class SpellBertPho2ResArch3Contrast(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -2681,10 +3018,8 @@ class SpellBertPho2ResArch3Contrast(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -2697,7 +3032,7 @@ class SpellBertPho2ResArch3Contrast(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('/home/jhliang/Research/ReaLiSe/simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -2710,7 +3045,7 @@ class SpellBertPho2ResArch3Contrast(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -2720,7 +3055,7 @@ class SpellBertPho2ResArch3Contrast(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -2742,9 +3077,8 @@ class SpellBertPho2ResArch3Contrast(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
@@ -2821,36 +3155,17 @@ class SpellBertPho2ResArch3Contrast(BertPreTrainedModel):
             loss = loss_fct(active_logits, active_labels)
             # outputs = (loss,) + outputs
         
-            # Get negative samples from the same batch
-            sentence_hiddens = hiddens.clone().mean(dim=1)
-            negative_hiddens = hiddens.clone().mean(dim=1)
-            # negative_hiddens = negative_hiddens.mean(dim=1)
-            negative_hiddens = negative_hiddens.view(-1, hiddens.size(-1))
-            negative_hiddens = negative_hiddens[torch.randperm(negative_hiddens.size(0))].view(negative_hiddens.size())
-            
-            # Calculate contrastive loss using InfoNCE
-            temperature = 0.9  # Temperature parameter for scaling logits
-            batch_size = hiddens.size(0)
-
-            # Normalize the hidden vectors
-            sentence_hiddens_normalized = torch.nn.functional.normalize(sentence_hiddens, dim=-1)
-            negative_hiddens_normalized = torch.nn.functional.normalize(negative_hiddens, dim=-1)
-
-            # Calculate similarity scores (dot product) between positive and negative samples
-            similarity_scores = torch.matmul(sentence_hiddens_normalized, negative_hiddens_normalized.transpose(0, 1))
-
-            # Calculate the logits by dividing the similarity scores by the temperature
-            logits = similarity_scores / temperature
-
-            # Create target labels (1 for positive samples, 0 for negative samples)
-            targets = torch.arange(batch_size, device=hiddens.device)
-
-            # Calculate the contrastive loss using InfoNCE loss
-        
-            contrastive_loss = torch.nn.functional.cross_entropy(logits, targets)
-
-
-            total_loss = loss + 0.1 * contrastive_loss
+            # The positive of a sentence is the bert encoding of its target, the other sentences of
+            # the batch are its negatives (the hardest num_negatives of them)
+            total_loss = loss
+            if self.training and input_shape[0] > 1:
+                mask = attention_mask.to(hiddens.dtype).unsqueeze(2)
+                sentence_hiddens = (hiddens * mask).sum(dim=1) / mask.sum(dim=1)
+                with torch.no_grad():
+                    target_hiddens = self.bert(label_ids, attention_mask=attention_mask)[0]
+                    target_hiddens = (target_hiddens * mask).sum(dim=1) / mask.sum(dim=1)
+                contrastive_loss = self.contrastive_loss.in_batch(sentence_hiddens, target_hiddens)
+                total_loss = loss + 0.1 * contrastive_loss
             outputs = (total_loss,) + outputs
         return outputs
 
@@ -2889,11 +3204,9 @@ class SpellBertPho2ResArch3SoftMask(BertPreTrainedModel):
         self.pho_model = BertModel(pho_config)
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -2923,7 +3236,7 @@ class SpellBertPho2ResArch3SoftMask(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -2946,10 +3259,8 @@ class SpellBertPho2ResArch3SoftMask(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -2962,7 +3273,7 @@ class SpellBertPho2ResArch3SoftMask(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('/home/jhliang/research/ReaLiSe/simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -2975,7 +3286,7 @@ class SpellBertPho2ResArch3SoftMask(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -2985,7 +3296,7 @@ class SpellBertPho2ResArch3SoftMask(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -3007,9 +3318,8 @@ class SpellBertPho2ResArch3SoftMask(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
@@ -3148,11 +3458,9 @@ class SpellBertPho2ResArch3SoftMaskArch2(BertPreTrainedModel):
         self.pho_model = BertModel(pho_config)
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -3182,7 +3490,7 @@ class SpellBertPho2ResArch3SoftMaskArch2(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -3205,10 +3513,8 @@ class SpellBertPho2ResArch3SoftMaskArch2(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -3221,7 +3527,7 @@ class SpellBertPho2ResArch3SoftMaskArch2(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('/home/jhliang/Research/ReaLiSe/simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -3234,7 +3540,7 @@ class SpellBertPho2ResArch3SoftMaskArch2(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -3244,7 +3550,7 @@ class SpellBertPho2ResArch3SoftMaskArch2(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -3266,9 +3572,8 @@ class SpellBertPho2ResArch3SoftMaskArch2(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
@@ -3411,11 +3716,9 @@ class SpellBertPho2ResArch3SoftMaskArch3(BertPreTrainedModel):
         self.pho_model = BertModel(pho_config)
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -3445,7 +3748,7 @@ class SpellBertPho2ResArch3SoftMaskArch3(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -3468,10 +3771,8 @@ class SpellBertPho2ResArch3SoftMaskArch3(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -3484,7 +3785,7 @@ class SpellBertPho2ResArch3SoftMaskArch3(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('/home/wtl/research/ReaLiSe/simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -3497,7 +3798,7 @@ class SpellBertPho2ResArch3SoftMaskArch3(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -3507,7 +3808,7 @@ class SpellBertPho2ResArch3SoftMaskArch3(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -3529,9 +3830,8 @@ class SpellBertPho2ResArch3SoftMaskArch3(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
@@ -3644,6 +3944,11 @@ class SpellBertPho2ResArch3SoftMaskArch3(BertPreTrainedModel):
 
 
 class SpellBertPho2ResArch3SoftMaskArch3Wubi(BertPreTrainedModel):
+    # Accepts packed rows (segment_ids / position_ids, see --pack_sequences)
+    supports_packing = True
+    # With track_example_losses set, forward leaves the detached loss of every sentence in example_losses
+    track_example_losses = False
+    example_losses = None
 
     def __init__(self, config):
         super(SpellBertPho2ResArch3SoftMaskArch3Wubi, self).__init__(config)
@@ -3679,11 +3984,9 @@ class SpellBertPho2ResArch3SoftMaskArch3Wubi(BertPreTrainedModel):
         self.pho_model = BertModel(pho_config)
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -3731,7 +4034,7 @@ class SpellBertPho2ResArch3SoftMaskArch3Wubi(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -3754,10 +4057,8 @@ class SpellBertPho2ResArch3SoftMaskArch3Wubi(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -3770,7 +4071,7 @@ class SpellBertPho2ResArch3SoftMaskArch3Wubi(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('/home/wtl/research/ReaLiSe/simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -3783,7 +4084,7 @@ class SpellBertPho2ResArch3SoftMaskArch3Wubi(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -3793,7 +4094,7 @@ class SpellBertPho2ResArch3SoftMaskArch3Wubi(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -3815,82 +4116,42 @@ class SpellBertPho2ResArch3SoftMaskArch3Wubi(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
     def build_batch(batch, tokenizer):
-        src_idx = batch['src_idx'].flatten().tolist()
-        chars = tokenizer.convert_ids_to_tokens(src_idx)
-        pho_idx, pho_lens = pho2_convertor.convert(chars)
-        wubi_idx, wubi_lens = wubi_convertor.convert(chars)
-        batch['pho_idx'] = pho_idx
-        batch['pho_lens'] = pho_lens
-        batch['wubi_idx'] = wubi_idx
-        batch['wubi_lens'] = wubi_lens
-        return batch
+        return build_unique_batch(batch, tokenizer, wubi=True)
 
-    def forward(self, batch):
+    def encode(self, batch):
+        '''Everything up to the classifier: (sequence_output, hiddens, detect_logits, output_block outputs).'''
         input_ids = batch['src_idx']
-        attention_mask = batch['masks']
-        loss_mask = batch['loss_masks']
-        pho_idx = batch['pho_idx']
-        pho_lens = batch['pho_lens']
-        wubi_idx = batch['wubi_idx']
-        wubi_lens = batch['wubi_lens']
-        label_ids = batch['tgt_idx'] if 'tgt_idx' in batch else None
-        detect_label_ids = torch.where(input_ids == label_ids, torch.tensor(0).to(input_ids.device), torch.tensor(1).to(input_ids.device))
+        attention_mask = _attention_mask(batch)
+        position_ids = batch.get('position_ids')
 
-        input_shape = input_ids.size()
-
-        bert_hiddens = self.bert(input_ids, attention_mask=attention_mask)[0]
+        bert_hiddens = self.bert(input_ids, attention_mask=attention_mask, position_ids=position_ids)[0]
         # bert_hiddens [bsz,max_len,hid_dim]
         
         
-        hiddens_detect = self.hiddens_gru(bert_hiddens)[0]
+        hiddens_detect = _sentence_gru(self.hiddens_gru, bert_hiddens, batch)
         detect_logits = self.detect_classifier(hiddens_detect)
         detect_logits = torch.sigmoid(detect_logits)
 
 
-        pho_embeddings = self.pho_embeddings(pho_idx)
-        pho_embeddings = torch.nn.utils.rnn.pack_padded_sequence(
-            input=pho_embeddings,
-            lengths=pho_lens,
-            batch_first=True,
-            enforce_sorted=False,
-        )
-        _, pho_hiddens = self.pho_gru(pho_embeddings)
-        pho_hiddens = pho_hiddens.squeeze(0).reshape(input_shape[0], input_shape[1], -1).contiguous()
-        pho_hiddens = self.pho_model(inputs_embeds=pho_hiddens, attention_mask=attention_mask)[0]
+        pho_hiddens = _pho_gru_hiddens(self, batch)
+        with _branch_context(self, 'pho'):
+            pho_hiddens = self.pho_model(inputs_embeds=pho_hiddens, attention_mask=attention_mask, position_ids=position_ids)[0]
 
-        src_idxs = input_ids.view(-1)
+        res_hiddens = _res_hiddens(self, batch)
 
-        if self.config.num_fonts == 1:
-            images = self.char_images(src_idxs).reshape(src_idxs.shape[0], 1, 32, 32).contiguous()
-        else:
-            images = self.char_images_multifonts.index_select(dim=0, index=src_idxs)
 
-        res_hiddens = self.resnet(images)
-        res_hiddens = res_hiddens.reshape(input_shape[0], input_shape[1], -1).contiguous()
-        res_hiddens = self.resnet_layernorm(res_hiddens)
+        wubi_hiddens = _wubi_gru_hiddens(self, batch)
+        with _branch_context(self, 'wubi'):
+            wubi_hiddens = self.wubi_model(inputs_embeds=wubi_hiddens, attention_mask=attention_mask, position_ids=position_ids)[0]
 
 
-        wubi_embeddings = self.wubi_embeddings(wubi_idx)
-        wubi_embeddings = torch.nn.utils.rnn.pack_padded_sequence(
-            input=wubi_embeddings,
-            lengths=wubi_lens,
-            batch_first=True,
-            enforce_sorted=False,
-        )
-        _, wubi_hiddens = self.wubi_gru(wubi_embeddings)
-        wubi_hiddens = wubi_hiddens.squeeze(0).reshape(input_shape[0], input_shape[1], -1).contiguous()
-        wubi_hiddens = self.wubi_model(inputs_embeds=wubi_hiddens, attention_mask=attention_mask)[0]
-
-
-        bert_hiddens_mean = (bert_hiddens * attention_mask.to(torch.float).unsqueeze(2)).sum(dim=1) / attention_mask.to(torch.float).sum(dim=1, keepdim=True)
-        bert_hiddens_mean = bert_hiddens_mean.unsqueeze(1).expand(-1, bert_hiddens.size(1), -1)
+        bert_hiddens_mean = _sentence_mean(bert_hiddens, batch)
 
         concated_outputs = torch.cat((bert_hiddens, pho_hiddens, res_hiddens, wubi_hiddens, bert_hiddens_mean), dim=-1)
         
@@ -3919,39 +4180,48 @@ class SpellBertPho2ResArch3SoftMaskArch3Wubi(BertPreTrainedModel):
         sequence_output += hiddens # residual connection
 
         sequence_output = self.dropout(sequence_output)
-        logits = self.classifier(sequence_output)
+        return sequence_output, hiddens, detect_logits, outputs
+
+    def forward(self, batch, return_logits=None):
+        '''
+        return_logits defaults to (not self.training). Without logits the vocab loss is computed on the
+        loss_mask positions only, in checkpointed chunks, and [B, S, V] logits are never built;
+        the logits slot of the outputs is then None.
+        '''
+        input_ids = batch['src_idx']
+        loss_mask = batch['loss_masks']
+        label_ids = batch['tgt_idx'] if 'tgt_idx' in batch else None
+        detect_label_ids = torch.where(input_ids == label_ids, torch.tensor(0).to(input_ids.device), torch.tensor(1).to(input_ids.device))
+        if return_logits is None:
+            return_logits = not self.training or label_ids is None
+
+        sequence_output, hiddens, detect_logits, outputs = self.encode(batch)
+        logits = self.classifier(sequence_output) if return_logits else None
         outputs = (logits,) + (hiddens,) + outputs[2:]  # add hidden states and attention if they are here
         if label_ids is not None:
 
-            loss_fct = CrossEntropyLoss()
             # Only keep active parts of the loss
             active_loss = loss_mask.view(-1) == 1
-            active_logits = logits.view(-1, self.vocab_size)[active_loss]
             active_labels = label_ids.view(-1)[active_loss]
-            loss = loss_fct(active_logits, active_labels)
+            reduction = 'none' if self.track_example_losses else 'mean'
+            if logits is not None:
+                active_logits = logits.view(-1, self.vocab_size)[active_loss]
+                loss = torch.nn.functional.cross_entropy(active_logits, active_labels, reduction=reduction)
+            else:
+                active_hiddens = sequence_output.view(-1, sequence_output.size(-1))[active_loss]
+                loss = chunked_cross_entropy(self.classifier, active_hiddens, active_labels, reduction=reduction)
 
             # Add detection loss here
             active_detect_loss = loss_mask.view(-1) == 1
             active_detect_logits = detect_logits.view(-1, 2)[active_detect_loss]
             active_detect_labels = detect_label_ids.view(-1)[active_detect_loss]
-            detect_loss = loss_fct(active_detect_logits, active_detect_labels)
+            detect_loss = torch.nn.functional.cross_entropy(active_detect_logits, active_detect_labels, reduction=reduction)
+            if self.track_example_losses:
+                token_losses = self.alpha * loss.detach() + (1-self.alpha) * detect_loss.detach()
+                self.example_losses = example_losses(token_losses, batch, active_loss)
+                loss, detect_loss = loss.mean(), detect_loss.mean()
 
-            # Add contrastive loss here
-            # active_logits: the prediction probability for all characters in vocabulary
-            # pos_idx: the index of postive sample in vocabulary
-            # K: the selected negative samples amount 
-            # active_probability = torch.softmax(active_logits,dim=1)
-            # seq_label = torch.arange(active_probability.shape[0])
-            # pos_prob = active_probability[seq_label,active_labels]
-            # neg_prob = torch.topk(active_probability,self.top_k)[0]
-            # neg_idx = torch.topk(active_probability,self.top_k)[1]
-
-            # # contrastive probability optimization objective
-            # loss_list = []
-            # for x in range(0,self.top_k):
-            #     if neg_idx[:,x].tolist() != active_labels.tolist():
-            #         loss_list.append(pos_prob-neg_prob[:,x])
-            # cl_loss = -torch.stack(loss_list).mean() 
+            # No contrastive loss here, see SpellBertPho2ResArch3SoftMaskArch3WubiContrast / ContrastiveLoss
             cl_loss=0
             total_loss = self.alpha * loss + (1-self.alpha) * detect_loss + self.beta * cl_loss
             outputs = (total_loss,) + outputs
@@ -3993,11 +4263,9 @@ class SpellBertPho2ResArch3SoftMaskArch3WubiContrast(BertPreTrainedModel):
         self.pho_model = BertModel(pho_config)
 
         if self.config.num_fonts == 1:
-            self.char_images = nn.Embedding(config.vocab_size, 1024)
-            self.char_images.weight.requires_grad = False
+            self.char_images = GlyphTable(config.vocab_size)
         else:
-            self.char_images_multifonts = torch.nn.Parameter(torch.rand(21128, self.config.num_fonts, 32, 32))
-            self.char_images_multifonts.requires_grad = False
+            self.char_images_multifonts = GlyphTable(21128, self.config.num_fonts)
 
         if config.image_model_type == 0:
             self.resnet = CharResNet(in_channels=self.config.num_fonts)
@@ -4035,6 +4303,7 @@ class SpellBertPho2ResArch3SoftMaskArch3WubiContrast(BertPreTrainedModel):
         self.alpha = 0.5
         self.beta = 1
         self.top_k = 5
+        self.contrastive_loss = contrastive_loss_from_config(config, num_negatives=self.top_k, temperature=1.0)
         self.init_weights()
 
     def tie_cls_weight(self):
@@ -4045,7 +4314,7 @@ class SpellBertPho2ResArch3SoftMaskArch3WubiContrast(BertPreTrainedModel):
         with open(vocab_path, 'r', encoding='utf-8') as f:
             vocab = [s.strip() for s in f]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -4068,10 +4337,8 @@ class SpellBertPho2ResArch3SoftMaskArch3WubiContrast(BertPreTrainedModel):
 
             char_images.append(image)
         char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).reshape(char_images.shape[0], -1)
-        assert char_images.shape == (21128, 1024)
-        self.char_images.weight.data.copy_(char_images)
+        assert char_images.shape == (21128, font_size, font_size)
+        self.char_images.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_multifonts(self, vocab_dir, num_fonts, use_traditional_font, font_size=32):
@@ -4084,7 +4351,7 @@ class SpellBertPho2ResArch3SoftMaskArch3WubiContrast(BertPreTrainedModel):
         if use_traditional_font:
             font_paths = font_paths[:-1]
             font_paths.append(('/home/wtl/research/ReaLiSe/simhei.ttf', True))
-            self.converter = opencc.OpenCC('s2t.json')
+            self.converter = _opencc().OpenCC('s2t.json')
 
         images_list = []
         for font_path, use_traditional in font_paths:
@@ -4097,7 +4364,7 @@ class SpellBertPho2ResArch3SoftMaskArch3WubiContrast(BertPreTrainedModel):
             images_list.append(images)
 
         char_images = torch.stack(images_list, dim=1).contiguous()
-        self.char_images_multifonts.data.copy_(char_images)
+        self.char_images_multifonts.set_images(char_images)
 
     # Add by hengdaxu
     def build_glyce_embed_onefont(self, vocab_dir, font_path, font_size, use_traditional):
@@ -4107,7 +4374,7 @@ class SpellBertPho2ResArch3SoftMaskArch3WubiContrast(BertPreTrainedModel):
         if use_traditional:
             vocab = [self.converter.convert(c) if len(c) == 1 else c for c in vocab]
 
-        font = ImageFont.truetype(font_path, size=font_size)
+        font = _image_font().truetype(font_path, size=font_size)
 
         char_images = []
         for char in vocab:
@@ -4129,31 +4396,18 @@ class SpellBertPho2ResArch3SoftMaskArch3WubiContrast(BertPreTrainedModel):
                 image = back_image
 
             char_images.append(image)
-        char_images = np.array(char_images)
-        char_images = (char_images - np.mean(char_images)) / np.std(char_images)
-        char_images = torch.from_numpy(char_images).contiguous()
+        # Raw font masks, normalized per font by GlyphTable
+        char_images = torch.from_numpy(np.array(char_images))
         return char_images
 
     @staticmethod
     def build_batch(batch, tokenizer):
-        src_idx = batch['src_idx'].flatten().tolist()
-        chars = tokenizer.convert_ids_to_tokens(src_idx)
-        pho_idx, pho_lens = pho2_convertor.convert(chars)
-        wubi_idx, wubi_lens = wubi_convertor.convert(chars)
-        batch['pho_idx'] = pho_idx
-        batch['pho_lens'] = pho_lens
-        batch['wubi_idx'] = wubi_idx
-        batch['wubi_lens'] = wubi_lens
-        return batch
+        return build_unique_batch(batch, tokenizer, wubi=True)
 
     def forward(self, batch):
         input_ids = batch['src_idx']
         attention_mask = batch['masks']
         loss_mask = batch['loss_masks']
-        pho_idx = batch['pho_idx']
-        pho_lens = batch['pho_lens']
-        wubi_idx = batch['wubi_idx']
-        wubi_lens = batch['wubi_lens']
         label_ids = batch['tgt_idx'] if 'tgt_idx' in batch else None
         detect_label_ids = torch.where(input_ids == label_ids, torch.tensor(0).to(input_ids.device), torch.tensor(1).to(input_ids.device))
 
@@ -4168,39 +4422,16 @@ class SpellBertPho2ResArch3SoftMaskArch3WubiContrast(BertPreTrainedModel):
         detect_logits = torch.sigmoid(detect_logits)
 
 
-        pho_embeddings = self.pho_embeddings(pho_idx)
-        pho_embeddings = torch.nn.utils.rnn.pack_padded_sequence(
-            input=pho_embeddings,
-            lengths=pho_lens,
-            batch_first=True,
-            enforce_sorted=False,
-        )
-        _, pho_hiddens = self.pho_gru(pho_embeddings)
-        pho_hiddens = pho_hiddens.squeeze(0).reshape(input_shape[0], input_shape[1], -1).contiguous()
-        pho_hiddens = self.pho_model(inputs_embeds=pho_hiddens, attention_mask=attention_mask)[0]
-
-        src_idxs = input_ids.view(-1)
-
-        if self.config.num_fonts == 1:
-            images = self.char_images(src_idxs).reshape(src_idxs.shape[0], 1, 32, 32).contiguous()
-        else:
-            images = self.char_images_multifonts.index_select(dim=0, index=src_idxs)
+        pho_hiddens = _pho_gru_hiddens(self, batch)
+        with _branch_context(self, 'pho'):
+            pho_hiddens = self.pho_model(inputs_embeds=pho_hiddens, attention_mask=attention_mask)[0]
 
-        res_hiddens = self.resnet(images)
-        res_hiddens = res_hiddens.reshape(input_shape[0], input_shape[1], -1).contiguous()
-        res_hiddens = self.resnet_layernorm(res_hiddens)
+        res_hiddens = _res_hiddens(self, batch)
 
 
-        wubi_embeddings = self.wubi_embeddings(wubi_idx)
-        wubi_embeddings = torch.nn.utils.rnn.pack_padded_sequence(
-            input=wubi_embeddings,
-            lengths=wubi_lens,
-            batch_first=True,
-            enforce_sorted=False,
-        )
-        _, wubi_hiddens = self.wubi_gru(wubi_embeddings)
-        wubi_hiddens = wubi_hiddens.squeeze(0).reshape(input_shape[0], input_shape[1], -1).contiguous()
-        wubi_hiddens = self.wubi_model(inputs_embeds=wubi_hiddens, attention_mask=attention_mask)[0]
+        wubi_hiddens = _wubi_gru_hiddens(self, batch)
+        with _branch_context(self, 'wubi'):
+            wubi_hiddens = self.wubi_model(inputs_embeds=wubi_hiddens, attention_mask=attention_mask)[0]
 
 
         bert_hiddens_mean = (bert_hiddens * attention_mask.to(torch.float).unsqueeze(2)).sum(dim=1) / attention_mask.to(torch.float).sum(dim=1, keepdim=True)
@@ -4250,18 +4481,73 @@ class SpellBertPho2ResArch3SoftMaskArch3WubiContrast(BertPreTrainedModel):
             active_detect_labels = detect_label_ids.view(-1)[active_detect_loss]
             detect_loss = loss_fct(active_detect_logits, active_detect_labels)
 
-            seq_label = torch.arange(active_labels.shape[0])
-            pos_prob = active_logits[seq_label, active_labels]
-            neg_prob = torch.topk(active_logits, self.top_k)[0]
-            neg_idx = torch.topk(active_logits, self.top_k)[1]
+            # Contrastive probability optimization objective: the gold label against the top_k wrong labels
+            cl_loss = self.contrastive_loss.token(active_logits, active_labels)
 
+            total_loss = self.alpha * loss + (1-self.alpha) * detect_loss + self.beta * cl_loss
+            outputs = (total_loss,) + outputs
+        return outputs 
 
-            # Contrastive probability optimization objective
-            loss_list = []
-            for x in range(self.top_k):
-                loss_list.append(-torch.relu(neg_prob[:,x] - pos_prob))  # Use relu to set positive to 0 (when prob of gold label is greater than prob of prediction)
-            cl_loss = -torch.stack(loss_list).mean()
 
-            total_loss = self.alpha * loss + (1-self.alpha) * detect_loss + self.beta * cl_loss
+class SpellBertPho2ResArch3SoftMaskArch3WubiEdit(SpellBertPho2ResArch3SoftMaskArch3Wubi):
+    '''
+    SoftMaskArch3Wubi with an edit-tagging head (KEEP / REPLACE(c) / MERGE(c), see edit_tags).
+    A splitting correction is one MERGE prediction at the first character instead of a '#' plus
+    a character, so the vocab classifier is never trained on the '#' filler.
+    '''
+
+    def __init__(self, config):
+        super(SpellBertPho2ResArch3SoftMaskArch3WubiEdit, self).__init__(config)
+        self.edit_classifier = nn.Linear(config.hidden_size, NUM_EDIT_TAGS)
+        self._init_weights(self.edit_classifier)
+
+    @staticmethod
+    def build_batch(batch, tokenizer):
+        batch = SpellBertPho2ResArch3SoftMaskArch3Wubi.build_batch(batch, tokenizer)
+        if 'tgt_idx' in batch:
+            batch['edit_labels'], batch['char_labels'] = build_edit_labels(
+                batch['src_idx'], batch['tgt_idx'], batch['loss_masks'], tokenizer.convert_tokens_to_ids('#'))
+        return batch
+
+    def forward(self, batch, return_logits=None):
+        input_ids = batch['src_idx']
+        loss_mask = batch['loss_masks']
+        label_ids = batch['tgt_idx'] if 'tgt_idx' in batch else None
+        if return_logits is None:
+            return_logits = not self.training or label_ids is None
+
+        sequence_output, hiddens, detect_logits, outputs = self.encode(batch)
+        logits = self.classifier(sequence_output) if return_logits else None
+        edit_logits = self.edit_classifier(sequence_output)
+        outputs = (logits,) + (hiddens,) + (edit_logits,) + outputs[2:]
+        if label_ids is not None and 'edit_labels' in batch:
+            # With track_example_losses the losses are kept per position (0 where ignored) and averaged below
+            reduction = 'none' if self.track_example_losses else 'mean'
+            loss_fct = CrossEntropyLoss(ignore_index=IGNORE_INDEX, reduction=reduction)
+            char_labels, edit_labels = batch['char_labels'].view(-1), batch['edit_labels'].view(-1)
+            if logits is not None:
+                loss = loss_fct(logits.view(-1, self.vocab_size), char_labels)
+            else:
+                active = char_labels != IGNORE_INDEX
+                active_hiddens = sequence_output.view(-1, sequence_output.size(-1))[active]
+                loss = chunked_cross_entropy(self.classifier, active_hiddens, char_labels[active], ignore_index=IGNORE_INDEX, reduction=reduction)
+                if self.track_example_losses:
+                    loss = loss.new_zeros(char_labels.shape).masked_scatter(active, loss)
+            edit_loss = loss_fct(edit_logits.view(-1, NUM_EDIT_TAGS), edit_labels)
+
+            detect_label_ids = torch.where(input_ids == label_ids, torch.tensor(0).to(input_ids.device), torch.tensor(1).to(input_ids.device))
+            active_detect_loss = loss_mask.view(-1) == 1
+            active_detect_logits = detect_logits.view(-1, 2)[active_detect_loss]
+            active_detect_labels = detect_label_ids.view(-1)[active_detect_loss]
+            detect_loss = loss_fct(active_detect_logits, active_detect_labels)
+            if self.track_example_losses:
+                token_losses = (self.alpha * (loss.detach().float() + edit_loss.detach().float())[active_detect_loss]
+                                + (1-self.alpha) * detect_loss.detach().float())
+                self.example_losses = example_losses(token_losses, batch, active_detect_loss)
+                loss = loss.sum() / (char_labels != IGNORE_INDEX).sum().clamp(min=1)
+                edit_loss = edit_loss.sum() / (edit_labels != IGNORE_INDEX).sum().clamp(min=1)
+                detect_loss = detect_loss.mean()
+
+            total_loss = self.alpha * (loss + edit_loss) + (1-self.alpha) * detect_loss
             outputs = (total_loss,) + outputs
-        return outputs 
\ No newline at end of file
+        return outputs
@@ -0,0 +1,218 @@
+'''Per-branch profiling of the spelling models.
+
+BranchProfiler hooks the named sub-modules of a model (bert, pho_model, resnet, output_block, ...)
+and records, for every step, the forward wall time, CUDA time and peak memory of each branch,
+the FLOPs of each branch (when torch.utils.flop_counter is available) and the host-side time
+of the sections wrapped with section() (make_features, build_batch, ...).
+'''
+
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+try:
+    from torch.utils.flop_counter import FlopCounterMode
+except ImportError:
+    FlopCounterMode = None
+
+
+logger = logging.getLogger(__name__)
+
+BRANCHES = ('bert', 'hiddens_gru', 'detect_classifier', 'pho_embeddings', 'pho_gru', 'pho_model',
+            'resnet', 'wubi_embeddings', 'wubi_gru', 'wubi_model', 'gate_net', 'output_block', 'classifier')
+
+_active = None
+# Highest torch.cuda.max_memory_allocated seen before BranchProfiler reset it for a branch
+_peak_before_reset = 0
+
+
+@contextmanager
+def section(name, times=None):
+    '''
+    Time a host-side section into the dict times if given (e.g. to be carried with a batch
+    featurized ahead of its step or in a worker), else into the active profiler, if any.
+    '''
+    target = times if times is not None else (_active.host if _active is not None else None)
+    if target is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        target[name] = target.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+
+def max_memory_allocated(device=None):
+    '''torch.cuda.max_memory_allocated, including the peaks from before BranchProfiler's per-branch resets.'''
+    return max(_peak_before_reset, torch.cuda.max_memory_allocated(device))
+
+
+class BranchProfiler(object):
+
+    def __init__(self, model, branches=BRANCHES, max_steps=None, count_flops=True):
+        self.model = model.module if hasattr(model, 'module') else model
+        self.branches = [name for name in branches if getattr(self.model, name, None) is not None]
+        self.max_steps = max_steps
+        self.count_flops = count_flops and FlopCounterMode is not None
+        self.cuda = next(self.model.parameters()).is_cuda
+        self.steps = []
+        self.handles = []
+        self._reset_step()
+
+    def _reset_step(self):
+        self.wall = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.peak = {}
+        self.events = defaultdict(list)
+        self.flops = {}
+        self.host = defaultdict(float)
+        self._starts = {}
+
+    @property
+    def enabled(self):
+        return self.max_steps is None or len(self.steps) < self.max_steps
+
+    def add_host(self, times):
+        '''Add host-side section times measured outside the profiler (see section) to the current step.'''
+        if self.enabled:
+            for name, value in times.items():
+                self.host[name] += value
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            if not self.enabled:
+                return
+            self._sync()
+            if self.cuda:
+                global _peak_before_reset
+                _peak_before_reset = max(_peak_before_reset, torch.cuda.max_memory_allocated())
+                torch.cuda.reset_peak_memory_stats()
+                start_event = torch.cuda.Event(enable_timing=True)
+                start_event.record()
+                self.events[name].append([start_event, None])
+            self._starts[name] = time.perf_counter()
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, outputs):
+            if not self.enabled or name not in self._starts:
+                return
+            if self.cuda:
+                end_event = torch.cuda.Event(enable_timing=True)
+                end_event.record()
+                self.events[name][-1][1] = end_event
+            self._sync()
+            self.wall[name] += (time.perf_counter() - self._starts.pop(name)) * 1000
+            self.calls[name] += 1
+            if self.cuda:
+                self.peak[name] = max(self.peak.get(name, 0), torch.cuda.max_memory_allocated() / 2**20)
+        return hook
+
+    def start(self):
+        global _active
+        for name in self.branches:
+            module = getattr(self.model, name)
+            self.handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self._post_hook(name)))
+        _active = self
+        return self
+
+    def stop(self):
+        global _active
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        if _active is self:
+            _active = None
+
+    @contextmanager
+    def forward(self):
+        '''Wrap a model forward: times it as a whole and counts FLOPs per branch.'''
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        start = time.perf_counter()
+        if self.count_flops:
+            with FlopCounterMode(display=False) as counter:
+                yield
+            for key, count in counter.get_flop_counts().items():
+                name = key.split('.')[-1]
+                if name in self.branches:
+                    self.flops[name] = self.flops.get(name, 0) + sum(count.values())
+            self.flops['forward'] = self.flops.get('forward', 0) + sum(counter.get_flop_counts().get('Global', {}).values())
+        else:
+            yield
+        self._sync()
+        self.wall['forward'] += (time.perf_counter() - start) * 1000
+
+    def step(self):
+        '''Close the record of the current step.'''
+        if not self.enabled:
+            return
+        record = {'step': len(self.steps), 'host_ms': dict(self.host), 'branches': {}}
+        if self.cuda:
+            torch.cuda.synchronize()
+        for name in set(self.wall) | set(self.flops):
+            branch = {'wall_ms': self.wall.get(name, 0.0), 'calls': self.calls.get(name, 0)}
+            if self.events.get(name):
+                branch['cuda_ms'] = sum(s.elapsed_time(e) for s, e in self.events[name] if e is not None)
+            if name in self.peak:
+                branch['peak_mb'] = self.peak[name]
+            if name in self.flops:
+                branch['flops'] = self.flops[name]
+            record['branches'][name] = branch
+        self.steps.append(record)
+        self._reset_step()
+
+    def summary(self):
+        '''Per branch mean over the recorded steps, with the share of the forward wall time.'''
+        totals = defaultdict(lambda: defaultdict(float))
+        host = defaultdict(float)
+        for record in self.steps:
+            for name, branch in record['branches'].items():
+                for key, value in branch.items():
+                    totals[name][key] += value
+            for name, value in record['host_ms'].items():
+                host[name] += value
+        n = max(len(self.steps), 1)
+        branches = dict((name, dict((k, v / n) for k, v in values.items())) for name, values in totals.items())
+        forward_ms = branches.get('forward', {}).get('wall_ms', 0.0)
+        for name, branch in branches.items():
+            if forward_ms > 0 and name != 'forward':
+                branch['share'] = branch['wall_ms'] / forward_ms
+        return {'steps': len(self.steps), 'branches': branches, 'host_ms': dict((k, v / n) for k, v in host.items())}
+
+    def log_summary(self):
+        summary = self.summary()
+        logger.info("***** Profile over %d steps (mean per step) *****", summary['steps'])
+        for name, branch in sorted(summary['branches'].items(), key=lambda x: -x[1]['wall_ms']):
+            logger.info("  %-18s wall %8.2f ms  cuda %8.2f ms  peak %8.1f MB  GFLOPs %8.2f  share %5.1f%%",
+                        name, branch['wall_ms'], branch.get('cuda_ms', 0.0), branch.get('peak_mb', 0.0),
+                        branch.get('flops', 0) / 1e9, 100 * branch.get('share', 1.0))
+        for name, value in summary['host_ms'].items():
+            logger.info("  %-18s host %8.2f ms", name, value)
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'summary': self.summary(), 'steps': self.steps}, f, indent=1)
+        logger.info("Profile written to %s", path)
+
+    def write_tensorboard(self, writer, global_step_offset=0):
+        for record in self.steps:
+            step = global_step_offset + record['step']
+            for name, branch in record['branches'].items():
+                for key, value in branch.items():
+                    if key != 'calls':
+                        writer.add_scalar('profile/%s/%s' % (name, key), value, step)
+            for name, value in record['host_ms'].items():
+                writer.add_scalar('profile/host/%s' % name, value, step)
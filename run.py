@@ -1,11 +1,20 @@
 from __future__ import absolute_import, division, print_function
 
+import time
+_IMPORT_START = time.perf_counter()
+
 import argparse
 import glob
+import hashlib
+import importlib
 import logging
 import os
 import random
+import shutil
 import json
+import queue
+import threading
+from contextlib import nullcontext
 
 import numpy as np
 import torch
@@ -13,58 +22,93 @@ from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
                               TensorDataset)
 from torch.utils.data.distributed import DistributedSampler
 
-try:
-    from torch.utils.tensorboard import SummaryWriter
-except:
-    from tensorboardX import SummaryWriter
-
 from tqdm import tqdm, trange
 
-
-from transformers import (WEIGHTS_NAME, BertConfig, BertTokenizer)
-
-from transformers import AdamW, get_linear_schedule_with_warmup
-from metric import Metric
-from models import (SpellBert, SpellBertPho1, SpellBertPho2, 
-                        SpellBertPho1Res, SpellBertPho2Res, 
-                        SpellBertPho2ResArch2, SpellBertPho2ResArch3, SpellBertPho2ResArch3MLM,
-                        SpellBertPho2ResArch4, SpellBertPho2ResArch5, SpellBertPho2ResArch3Pos,
-                        SpellBertPho2ResArch3PosLoss,SpellBertPho2ResArch6, SpellBertPho2ResArch3Contrast,
-                        SpellBertPho2ResArch3SoftMask,SpellBertPho2ResArch3SoftMaskArch2,SpellBertPho2ResArch3SoftMaskArch3,
-                        SpellBertPho2ResArch3SoftMaskArch3Wubi,SpellBertPho2ResArch3SoftMaskArch3WubiContrast)
-from models_abla import SpellBertPho2ResArch3Abla
+from scoring import (correction_metrics, write_predictions, write_prediction_labels, load_labels,
+                     read_label_file, gold_from_labels)
+from edit_tags import merge_decode, edit_metrics
+from profiling import BranchProfiler, section, max_memory_allocated
+from checkpointing import (AsyncCheckpointWriter, BestCheckpoints, save_checkpoint, load_checkpoint, save_glyph_cache,
+                           rebuild_glyphs, GLYPH_CACHE_NAME, GLYPH_KEYS, TRAINING_STATE_NAME, WEIGHTS_NAME)
 
 import pickle
 
 
 logger = logging.getLogger(__name__)
 
+# Seconds spent importing, by module; see LazyModelRegistry
+IMPORT_TIMES = {}
+
+BERT = ('transformers.BertConfig', 'transformers.BertTokenizer')
 
-ALL_MODELS = sum((tuple(conf.pretrained_config_archive_map.keys()) for conf in (BertConfig, )), ())
-
-MODEL_CLASSES = {
-    'bert': (BertConfig, SpellBert, BertTokenizer),
-    # 'bert-wubi':(BertConfig, SpellBertWubi, BertTokenizer),
-    'bert-pho1': (BertConfig, SpellBertPho1, BertTokenizer),
-    'bert-pho2': (BertConfig, SpellBertPho2, BertTokenizer),
-    'bert-pho1-res': (BertConfig, SpellBertPho1Res, BertTokenizer),
-    'bert-pho2-res': (BertConfig, SpellBertPho2Res, BertTokenizer),
-    'bert-pho2-res-arch2': (BertConfig, SpellBertPho2ResArch2, BertTokenizer),
-    'bert-pho2-res-arch3': (BertConfig, SpellBertPho2ResArch3, BertTokenizer),
-    'bert-pho2-res-arch3-mlm': (BertConfig, SpellBertPho2ResArch3MLM, BertTokenizer),
-    'bert-pho2-res-arch4': (BertConfig, SpellBertPho2ResArch4, BertTokenizer),
-    'bert-pho2-res-arch5': (BertConfig, SpellBertPho2ResArch5, BertTokenizer),
-    'bert-pho2-res-arch3-pos' : (BertConfig, SpellBertPho2ResArch3Pos, BertTokenizer),
-    'bert-pho2-res-arch3-pos-loss': (BertConfig, SpellBertPho2ResArch3PosLoss, BertTokenizer),
-    'bert-pho2-res-arch3-abla': (BertConfig, SpellBertPho2ResArch3Abla, BertTokenizer),
-    'bert-pho2-res-arch6': (BertConfig,SpellBertPho2ResArch6, BertTokenizer),
-    'bert-pho2-res-arch3-contrast':(BertConfig,SpellBertPho2ResArch3Contrast,BertTokenizer),
-    'bert-pho2-res-arch3-softmask':(BertConfig,SpellBertPho2ResArch3SoftMask,BertTokenizer),
-    'bert-pho2-res-arch3-softmask-arch2':(BertConfig,SpellBertPho2ResArch3SoftMaskArch2,BertTokenizer),
-    'bert-pho2-res-arch3-softmask-arch3':(BertConfig,SpellBertPho2ResArch3SoftMaskArch3,BertTokenizer),
-    'bert-pho2-res-arch3-softmask-arch3-wubi':(BertConfig,SpellBertPho2ResArch3SoftMaskArch3Wubi,BertTokenizer),
-    'bert-pho2-res-arch3-softmask-arch3-wubi-contrast':(BertConfig,SpellBertPho2ResArch3SoftMaskArch3WubiContrast,BertTokenizer),
-}
+
+def import_object(path):
+    '''Import module.Name, recording the time the module import took the first time.'''
+    module_name, name = path.rsplit('.', 1)
+    if module_name not in IMPORT_TIMES:
+        start = time.perf_counter()
+        importlib.import_module(module_name)
+        IMPORT_TIMES[module_name] = time.perf_counter() - start
+    return getattr(importlib.import_module(module_name), name)
+
+
+class LazyModelRegistry(object):
+    '''
+    model_type -> (config class, model class, tokenizer class). Entries are import paths, so models.py,
+    transformers and their dependencies are only imported once a model type is looked up.
+    '''
+    def __init__(self, paths):
+        self.paths = paths
+        self.resolved = {}
+
+    def __getitem__(self, model_type):
+        if model_type not in self.resolved:
+            config_path, model_path, tokenizer_path = self.paths[model_type]
+            self.resolved[model_type] = (import_object(config_path), import_object(model_path), import_object(tokenizer_path))
+        return self.resolved[model_type]
+
+    def __contains__(self, model_type):
+        return model_type in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def keys(self):
+        return self.paths.keys()
+
+
+def _bert(model_path):
+    return (BERT[0], model_path, BERT[1])
+
+MODEL_CLASSES = LazyModelRegistry({
+    'bert': _bert('models.SpellBert'),
+    # 'bert-wubi': _bert('models.SpellBertWubi'),
+    'bert-pho1': _bert('models.SpellBertPho1'),
+    'bert-pho2': _bert('models.SpellBertPho2'),
+    'bert-pho1-res': _bert('models.SpellBertPho1Res'),
+    'bert-pho2-res': _bert('models.SpellBertPho2Res'),
+    'bert-pho2-res-arch2': _bert('models.SpellBertPho2ResArch2'),
+    'bert-pho2-res-arch3': _bert('models.SpellBertPho2ResArch3'),
+    'bert-pho2-res-arch3-mlm': _bert('models.SpellBertPho2ResArch3MLM'),
+    'bert-pho2-res-arch4': _bert('models.SpellBertPho2ResArch4'),
+    'bert-pho2-res-arch5': _bert('models.SpellBertPho2ResArch5'),
+    'bert-pho2-res-arch3-pos': _bert('models.SpellBertPho2ResArch3Pos'),
+    'bert-pho2-res-arch3-pos-loss': _bert('models.SpellBertPho2ResArch3PosLoss'),
+    'bert-pho2-res-arch3-abla': _bert('models_abla.SpellBertPho2ResArch3Abla'),
+    'bert-pho2-res-arch6': _bert('models.SpellBertPho2ResArch6'),
+    'bert-pho2-res-arch3-contrast': _bert('models.SpellBertPho2ResArch3Contrast'),
+    'bert-pho2-res-arch3-softmask': _bert('models.SpellBertPho2ResArch3SoftMask'),
+    'bert-pho2-res-arch3-softmask-arch2': _bert('models.SpellBertPho2ResArch3SoftMaskArch2'),
+    'bert-pho2-res-arch3-softmask-arch3': _bert('models.SpellBertPho2ResArch3SoftMaskArch3'),
+    'bert-pho2-res-arch3-softmask-arch3-wubi': _bert('models.SpellBertPho2ResArch3SoftMaskArch3Wubi'),
+    'bert-pho2-res-arch3-softmask-arch3-wubi-contrast': _bert('models.SpellBertPho2ResArch3SoftMaskArch3WubiContrast'),
+    'bert-pho2-res-arch3-softmask-arch3-wubi-edit': _bert('models.SpellBertPho2ResArch3SoftMaskArch3WubiEdit'),
+})
+
+IMPORT_TIMES['run'] = time.perf_counter() - _IMPORT_START
 
 
 def set_seed(args):
@@ -76,12 +120,49 @@ def set_seed(args):
         torch.backends.cudnn.deterministic = True
         torch.backends.cudnn.benchmark = False
 
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and 'cuda' in state:
+        torch.cuda.set_rng_state(state['cuda'])
+
 def create_dataset(args, input_file):
     input_file = os.path.join(args.data_dir, input_file)
     dataset = pickle.load(open(input_file, 'rb'))
     return dataset
 
-def make_features(args, examples, tokenizer, batch_processor):
+def augment_dataset(args, dataset, tokenizer):
+    '''Wrap the training examples so that every epoch re-corrupts them on the fly (see augment.py).'''
+    from augment import AugmentedDataset, ErrorGenerator
+    from utils import pho2_convertor, wubi_convertor
+    generator = ErrorGenerator.from_tokenizer(tokenizer, args.chaizi_path,
+                                              pho_convertor=pho2_convertor if args.augment_pho_prob > 0 else None,
+                                              wubi_convertor=wubi_convertor if args.augment_wubi_prob > 0 else None,
+                                              split_prob=args.augment_split_prob, pho_prob=args.augment_pho_prob,
+                                              wubi_prob=args.augment_wubi_prob, max_errors=args.augment_max_errors)
+    logger.info("Augmenting %.0f%% of the training examples per epoch (%d splittable, %d pho, %d wubi confusable chars)",
+                100 * args.augment_prob, len(generator.split_table), len(generator.pho_table), len(generator.wubi_table))
+    return AugmentedDataset(dataset, generator, args.augment_prob, seed=args.seed)
+
+def make_features(args, examples, tokenizer, batch_processor, host_ms=None):
+    with section('make_features', host_ms):
+        batch = _make_features(args, examples)
+    with section('build_batch', host_ms):
+        batch = batch_processor(batch, tokenizer)
+    return batch
+
+def _make_features(args, examples):
     '''
     max_length = -1
     for item in examples:
@@ -112,22 +193,136 @@ def make_features(args, examples, tokenizer, batch_processor):
     batch['tgt_idx'] = torch.tensor(batch['tgt_idx'], dtype=torch.long)
     batch['masks'] = torch.tensor(batch['masks'], dtype=torch.long)
     batch['loss_masks'] = torch.tensor(batch['loss_masks'], dtype=torch.long)
+    return batch
 
-    batch = batch_processor(batch, tokenizer)
+
+def pack_order(args, dataset, order):
+    '''
+    Group the examples of order into rows of at most max_seq_length tokens. Rows are filled best-fit
+    from the longest example down, so the number of rows depends on the example lengths only, not on
+    the shuffle; rows and the examples inside them then follow their first position in order.
+    '''
+    max_length = args.max_seq_length
+    lengths = [min(len(dataset[j]['src_idx']), max_length) for j in order]
+    rows = []
+    space = [[] for _ in range(max_length + 1)]  # space[r]: rows with r free tokens
+    for k in sorted(range(len(order)), key=lambda k: (-lengths[k], k)):
+        fit = next((r for r in range(lengths[k], max_length + 1) if space[r]), None)
+        if fit is None:
+            row, fit = len(rows), max_length
+            rows.append([])
+        else:
+            row = space[fit].pop()
+        rows[row].append(k)
+        space[fit - lengths[k]].append(row)
+    rows = [sorted(row) for row in rows]
+    return [[order[k] for k in row] for row in sorted(rows, key=lambda row: row[0])]
+
+def make_packed_features(args, rows, tokenizer, batch_processor, host_ms=None):
+    '''
+    Like make_features, but each row holds several sentences (each with its own [CLS] ... [SEP]).
+    segment_ids number the sentences of a row from 1 (0 on padding) and position_ids restart
+    at 0 for every sentence; the model builds block-diagonal attention from them.
+    '''
+    with section('make_features', host_ms):
+        batch = _make_packed_features(args, rows)
+    with section('build_batch', host_ms):
+        batch = batch_processor(batch, tokenizer)
+    return batch
+
+def _make_packed_features(args, rows):
+    max_length = args.max_seq_length
+    batch = {}
+    for t in ['id', 'src', 'tgt', 'tokens_size', 'lengths', 'src_idx', 'tgt_idx', 'masks', 'loss_masks', 'segment_ids', 'position_ids']:
+        batch[t] = []
+    for row in rows:
+        src_idx, tgt_idx, loss_mask, segment_ids, position_ids = [], [], [], [], []
+        for k, item in enumerate(row, start=1):
+            src_seq = item['src_idx'][:max_length]
+            tgt_seq = item['tgt_idx'][:max_length]
+            tgt_seq = tgt_seq + [0] * (len(src_seq) - len(tgt_seq))
+            n_loss = min(item['lengths'], len(src_seq) - 1)
+            src_idx += src_seq
+            tgt_idx += tgt_seq[:len(src_seq)]
+            loss_mask += [0] + [1] * n_loss + [0] * (len(src_seq) - 1 - n_loss)
+            segment_ids += [k] * len(src_seq)
+            position_ids += list(range(len(src_seq)))
+            for t in ['id', 'src', 'tgt', 'tokens_size', 'lengths']:
+                if t in item:
+                    batch[t].append(item[t])
+        padding_length = max_length - len(src_idx)
+        batch['src_idx'].append(src_idx + [0] * padding_length)
+        batch['tgt_idx'].append(tgt_idx + [0] * padding_length)
+        batch['masks'].append([1] * len(src_idx) + [0] * padding_length)
+        batch['loss_masks'].append(loss_mask + [0] * padding_length)
+        batch['segment_ids'].append(segment_ids + [0] * padding_length)
+        batch['position_ids'].append(position_ids + [0] * padding_length)
+    for t in ['src_idx', 'tgt_idx', 'masks', 'loss_masks', 'segment_ids', 'position_ids']:
+        batch[t] = torch.tensor(batch[t], dtype=torch.long)
     return batch
 
 
-def data_helper(args, dataset, tokenizer, batch_processor, is_eval=False):
+class FeaturizedBatches(torch.utils.data.Dataset):
+    '''The training batches of an epoch as a dataset, so that DataLoader workers featurize them.'''
+
+    def __init__(self, args, dataset, tokenizer, batch_processor, batches, packed):
+        self.args = args
+        self.dataset = dataset
+        self.tokenizer = tokenizer
+        self.batch_processor = batch_processor
+        self.batches = batches
+        self.packed = packed
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, k):
+        host_ms = {}
+        if self.packed:
+            rows = [[self.dataset[j] for j in row] for row in self.batches[k]]
+            batch = make_packed_features(self.args, rows, self.tokenizer, self.batch_processor, host_ms)
+        else:
+            examples = [self.dataset[j] for j in self.batches[k]]
+            batch = make_features(self.args, examples, self.tokenizer, self.batch_processor, host_ms)
+        batch['example_index'] = example_index(self.batches[k], self.packed)
+        batch['host_ms'] = host_ms
+        return batch
+
+def example_index(indices, packed):
+    '''Dataset indices of the sentences of a batch, in the order of the model's example_losses.'''
+    return [j for row in indices for j in row] if packed else list(indices)
+
+def data_helper(args, dataset, tokenizer, batch_processor, is_eval=False, order=None, start_batch=0):
+    '''
+    order is the shuffled index order of the epoch (drawn here if not given); the first
+    start_batch batches of it are skipped without being featurized. With --pack_sequences
+    a training batch is train_batch_size packed rows. With --dataloader_workers training
+    batches are featurized (and augmented) in worker processes.
+    '''
+    packed = not is_eval and args.pack_sequences
     if not is_eval:
-        random.shuffle(dataset)
-        start_position = 0
+        if order is None:
+            order = list(range(len(dataset)))
+            random.shuffle(order)
+        if packed:
+            order = pack_order(args, dataset, order)
+        start_position = start_batch * args.train_batch_size
+        if args.dataloader_workers > 0:
+            bs = args.train_batch_size
+            batches = [order[i:i+bs] for i in range(start_position, len(order), bs)]
+            loader = DataLoader(FeaturizedBatches(args, dataset, tokenizer, batch_processor, batches, packed),
+                                batch_size=None, shuffle=False, num_workers=args.dataloader_workers)
+            for batch in loader:
+                yield batch
+            return
         width = args.train_batch_size*5000
         intervals = []
-        while start_position < len(dataset):
-            intervals.append((start_position, min(start_position+width, len(dataset))))
+        while start_position < len(order):
+            intervals.append((start_position, min(start_position+width, len(order))))
             start_position += width
         bs = args.train_batch_size
     else:
+        order = range(len(dataset))
         intervals = [(0, len(dataset))]
         bs = args.eval_batch_size
 
@@ -135,7 +330,17 @@ def data_helper(args, dataset, tokenizer, batch_processor, is_eval=False):
         batches = []
         for i in range(l, r, bs):
             # This code takes a relatively long time.
-            batches.append(make_features(args, dataset[i:min(i+bs,r)], tokenizer, batch_processor))
+            # Training batches carry their featurization time, which is profiled with the step using them
+            host_ms = {} if not is_eval else None
+            if packed:
+                rows = [[dataset[j] for j in row] for row in order[i:min(i+bs,r)]]
+                batches.append(make_packed_features(args, rows, tokenizer, batch_processor, host_ms))
+            else:
+                examples = [dataset[j] for j in order[i:min(i+bs,r)]]
+                batches.append(make_features(args, examples, tokenizer, batch_processor, host_ms))
+            if not is_eval:
+                batches[-1]['example_index'] = example_index(order[i:min(i+bs,r)], packed)
+                batches[-1]['host_ms'] = host_ms
         for batch in batches:
             yield batch
 
@@ -152,12 +357,37 @@ def train(args, model, tokenizer, batch_processor):
         while start_position + width <= len(total_dataset):
             train_dataset.append(total_dataset[start_position+args.local_rank])
             start_position += width 
-
+    sampler = None
+    if args.hard_example_sampling:
+        from sampling import HardExampleSampler
+        sampler = HardExampleSampler.from_dataset(train_dataset, temperature=args.sampling_temperature,
+                                                  clean_floor=args.clean_replay_floor, momentum=args.loss_momentum,
+                                                  seed=args.seed)
+        model.track_example_losses = True
+    if args.augment_prob > 0:
+        train_dataset = augment_dataset(args, train_dataset, tokenizer)
+
+    train_state = None
+    if args.resume_from_checkpoint:
+        logger.info("Resuming training from %s", args.resume_from_checkpoint)
+        train_state = torch.load(os.path.join(args.resume_from_checkpoint, TRAINING_STATE_NAME), map_location='cpu')
+        # Glyphs are not part of the checkpoint, they were rebuilt before train(); any other mismatch is an error
+        missing, unexpected = model.load_state_dict(
+            torch.load(os.path.join(args.resume_from_checkpoint, WEIGHTS_NAME), map_location='cpu'), strict=False)
+        missing = [k for k in missing if k not in GLYPH_KEYS]
+        unexpected = [k for k in unexpected if k not in GLYPH_KEYS]
+        if missing or unexpected:
+            raise RuntimeError("Checkpoint %s does not match the model: missing %s, unexpected %s"
+                               % (args.resume_from_checkpoint, missing, unexpected))
+
+    # Rows per epoch; packing does not depend on the shuffle (only hard example sampling, which draws
+    # with replacement, and augmentation, which adds split characters, change it slightly)
+    num_train_rows = len(pack_order(args, train_dataset, range(len(train_dataset)))) if args.pack_sequences else len(train_dataset)
     if args.max_steps > 0:
         t_total = args.max_steps
-        args.num_train_epochs = args.max_steps // (len(train_dataset) // args.train_batch_size // args.gradient_accumulation_steps) + 1
+        args.num_train_epochs = args.max_steps // (num_train_rows // args.train_batch_size // args.gradient_accumulation_steps) + 1
     else:
-        t_total = len(train_dataset) // args.train_batch_size // args.gradient_accumulation_steps * args.num_train_epochs
+        t_total = num_train_rows // args.train_batch_size // args.gradient_accumulation_steps * args.num_train_epochs
 
     # Prepare optimizer and schedule (linear warmup and decay)
     no_decay = ['bias', 'LayerNorm.weight']
@@ -167,6 +397,7 @@ def train(args, model, tokenizer, batch_processor):
         {'params': [p for n, p in need_optimized_parameters if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
         ]
 
+    from transformers import AdamW, get_linear_schedule_with_warmup
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total)
     if args.fp16:
@@ -177,6 +408,14 @@ def train(args, model, tokenizer, batch_processor):
             raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
         model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16_opt_level)
 
+    if train_state is not None:
+        optimizer.load_state_dict(train_state['optimizer'])
+        scheduler.load_state_dict(train_state['scheduler'])
+        if args.fp16 and train_state.get('amp') is not None:
+            amp.load_state_dict(train_state['amp'])
+        if sampler is not None and train_state.get('sampler') is not None:
+            sampler.load_state_dict(train_state['sampler'])
+
     # Distributed training (should be after apex fp16 initialization)
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
@@ -186,6 +425,8 @@ def train(args, model, tokenizer, batch_processor):
     # Train!
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_dataset) * (torch.distributed.get_world_size() if args.local_rank != -1 else 1))
+    if args.pack_sequences:
+        logger.info("  Packed rows per epoch = %d (%.2f sentences per row)", num_train_rows, len(train_dataset) / max(num_train_rows, 1))
     logger.info("  Num Epochs = %d", args.num_train_epochs)
     logger.info("  Instantaneous batch size per GPU = %d", args.per_gpu_train_batch_size)
     logger.info("  Total train batch size (w. parallel, distributed & accumulation) = %d",
@@ -193,21 +434,60 @@ def train(args, model, tokenizer, batch_processor):
     logger.info("  Gradient Accumulation steps = %d", args.gradient_accumulation_steps)
     logger.info("  Total optimization steps = %d", t_total)
     
+    checkpoint_writer = AsyncCheckpointWriter(args.glyph_cache_path) if args.local_rank in [-1, 0] else None
+    eval_batches, best_checkpoints, eval_history = None, None, []
+    best_value, evals_since_best = None, 0
+    if args.eval_steps > 0:
+        eval_batches = dev_subset(load_eval_batches(args, args.dev_file, tokenizer, batch_processor), args.eval_subset_size)
+        best_checkpoints = BestCheckpoints(checkpoint_writer, args.num_save_ckpts, higher_is_better=args.metric_reverse)
+        if train_state is not None and train_state.get('best_checkpoints') is not None:
+            best_checkpoints.load_state_dict(train_state['best_checkpoints'])
+            best_value, evals_since_best = train_state['best_value'], train_state['evals_since_best']
+            eval_history = train_state.get('eval_history', [])
+        logger.info("  Evaluating every %d steps on %d dev sentences", args.eval_steps, sum(len(b['id']) for b in eval_batches))
+    stop_early = False
+    profiler = None
+    if args.profile_steps > 0 and args.local_rank in [-1, 0]:
+        profiler = BranchProfiler(model, max_steps=args.profile_steps).start()
+
     global_step = 0
     tr_loss, logging_loss = 0.0, 0.0
+    start_epoch, start_batch, epoch_order = 0, 0, None
     model.zero_grad()
     train_iterator = trange(int(args.num_train_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0])
     print(train_iterator)
     set_seed(args)  # Added here for reproductibility (even between python 2 and 3)
-    for _ in train_iterator:
+    if train_state is not None:
+        global_step = train_state['global_step']
+        tr_loss, logging_loss = train_state['tr_loss'], train_state['logging_loss']
+        start_epoch, start_batch, epoch_order = train_state['epoch'], train_state['steps_in_epoch'], train_state['epoch_order']
+        set_rng_state(train_state['rng'])
+        logger.info("  Continuing from epoch %d, batch %d, global step %d", start_epoch, start_batch, global_step)
+    for epoch in train_iterator:
+        if epoch < start_epoch:
+            continue
+        if hasattr(train_dataset, 'set_epoch'):
+            train_dataset.set_epoch(epoch)
+        if epoch_order is None and sampler is not None:
+            epoch_order = sampler.epoch_order(epoch)
+        elif epoch_order is None:
+            epoch_order = list(range(len(train_dataset)))
+            random.shuffle(epoch_order)
 
         # epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
-        for step, batch in enumerate(data_helper(args, train_dataset, tokenizer, batch_processor, False)):
+        for step, batch in enumerate(data_helper(args, train_dataset, tokenizer, batch_processor, False,
+                                                 order=epoch_order, start_batch=start_batch), start=start_batch):
             model.train()
+            host_ms = batch.pop('host_ms')
+            if profiler is not None:
+                profiler.add_host(host_ms)
             for t in batch:
-                if t not in ['id', 'src', 'tgt', 'lengths', 'tokens_size', 'pho_lens','pos_lens','wubi_lens']:
+                if t not in ['id', 'src', 'tgt', 'lengths', 'tokens_size', 'pho_lens','pos_lens','wubi_lens', 'example_index']:
                     batch[t] = batch[t].to(args.device)
-            loss = model(batch)[0]
+            with profiler.forward() if profiler is not None else nullcontext():
+                loss = model(batch)[0]
+            if sampler is not None:
+                sampler.update(batch['example_index'], (model.module if hasattr(model, 'module') else model).example_losses.cpu().numpy())
             
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
@@ -219,6 +499,10 @@ def train(args, model, tokenizer, batch_processor):
                 loss.backward()
 
             tr_loss += loss.item()
+            if profiler is not None:
+                profiler.step()
+                if not profiler.enabled and profiler.handles:
+                    finish_profile(args, profiler)
             if (step + 1) % args.gradient_accumulation_steps == 0:
                 if args.fp16:
                     torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
@@ -238,41 +522,153 @@ def train(args, model, tokenizer, batch_processor):
                     logs['loss'] = loss_scalar
                     logging_loss = tr_loss
                     logger.info("Step: {}, LR: {}, Loss: {}".format(global_step, logs['learning_rate'], logs['loss']))
-
-                if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
+                    if args.device.type == 'cuda':
+                        logger.info("Step: {}, Peak memory: {:.1f} MB".format(global_step, max_memory_allocated(args.device) / 2**20))
+
+                def training_state():
+                    if not args.save_training_state:
+                        return None
+                    return {TRAINING_STATE_NAME: {
+                        'optimizer': optimizer.state_dict(),
+                        'scheduler': scheduler.state_dict(),
+                        'amp': amp.state_dict() if args.fp16 else None,
+                        'rng': get_rng_state(),
+                        'global_step': global_step,
+                        'tr_loss': tr_loss,
+                        'logging_loss': logging_loss,
+                        'epoch': epoch,
+                        'steps_in_epoch': step + 1,
+                        'epoch_order': epoch_order,
+                        'sampler': sampler.state_dict() if sampler is not None else None,
+                        'best_checkpoints': best_checkpoints.state_dict() if best_checkpoints is not None else None,
+                        'best_value': best_value,
+                        'evals_since_best': evals_since_best,
+                        'eval_history': eval_history,
+                    }}
+
+                if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0 and eval_batches is None:
                     output_dir = os.path.join(args.output_dir, 'saved_ckpt-{}'.format(global_step))
-                    if not os.path.exists(output_dir):
-                        os.makedirs(output_dir)
-                    model_to_save = model.module if hasattr(model, 'module') else model  # Take care of distributed/parallel training
-                    model_to_save.save_pretrained(output_dir)
-                    torch.save(args, os.path.join(output_dir, 'training_args.bin'))
+                    checkpoint_writer.save(model, output_dir, args, extra_files=training_state())
                     logger.info("Saving model checkpoint to %s", output_dir)
 
-            if args.max_steps > 0 and global_step > args.max_steps:
+                if eval_batches is not None and global_step % args.eval_steps == 0:
+                    model_to_eval = model.module if hasattr(model, 'module') else model
+                    results = evaluate(args, model_to_eval, tokenizer, batch_processor, prefix='eval', eval_batches=eval_batches)
+                    eval_history.append((global_step, results))
+                    value = results[args.order_metric]
+                    improved = best_value is None or ((value > best_value if args.metric_reverse else value < best_value)
+                                                      and abs(value - best_value) > args.early_stopping_delta)
+                    if improved:
+                        best_value, evals_since_best = value, 0
+                    else:
+                        evals_since_best += 1
+                    output_dir = os.path.join(args.output_dir, 'saved_ckpt-{}'.format(global_step))
+                    if best_checkpoints.update(value, model, output_dir, args, training_state=training_state):
+                        logger.info("Step %d: %s = %s, keeping %s", global_step, args.order_metric, value, output_dir)
+                    if args.early_stopping_patience > 0 and evals_since_best >= args.early_stopping_patience:
+                        logger.info("Early stopping at step %d: no %s improvement in %d evaluations (best %s)",
+                                    global_step, args.order_metric, evals_since_best, best_value)
+                        stop_early = True
+
+            if args.max_steps > 0 and global_step > args.max_steps or stop_early:
                 break
-        if args.max_steps > 0 and global_step > args.max_steps:
+        epoch_order, start_batch = None, 0
+        if args.max_steps > 0 and global_step > args.max_steps or stop_early:
             train_iterator.close()
             break
+    if checkpoint_writer is not None:
+        checkpoint_writer.wait()
+    if eval_history:
+        json.dump(eval_history, open(os.path.join(args.output_dir, 'eval_history.json'), 'w', encoding='utf-8'), indent=1)
+        if args.target_value is not None:
+            from sampling import steps_to_target
+            logger.info("Steps to %s = %s on the dev subset: %s", args.order_metric, args.target_value,
+                        steps_to_target(eval_history, args.order_metric, args.target_value, higher_is_better=args.metric_reverse))
+    if profiler is not None and profiler.handles:
+        finish_profile(args, profiler)
+    if args.device.type == 'cuda':
+        logger.info("  Peak memory allocated = %.1f MB (gradient_checkpointing = %s)",
+                    max_memory_allocated(args.device) / 2**20, args.gradient_checkpointing)
     return global_step, tr_loss / global_step
 
-def evaluate(args, model, tokenizer, batch_processor, prefix=""):
-    eval_dataset = create_dataset(args, args.dev_file)
+def finish_profile(args, profiler):
+    profiler.stop()
+    profiler.log_summary()
+    profiler.dump(args.profile_output if args.profile_output else os.path.join(args.output_dir, 'profile.json'))
+    if args.profile_tensorboard:
+        try:
+            from torch.utils.tensorboard import SummaryWriter
+        except ImportError:
+            from tensorboardX import SummaryWriter
+        tb_writer = SummaryWriter(log_dir=os.path.join(args.output_dir, 'profile'))
+        profiler.write_tensorboard(tb_writer)
+        tb_writer.close()
+
+def file_hash(path, chunk_size=1<<20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def load_eval_batches(args, input_file, tokenizer, batch_processor):
+    '''
+    Featurized eval batches are cached next to the data, keyed by the content hash of
+    input_file, the model type (build_batch), max_seq_length and eval batch size.
+    '''
     args.eval_batch_size = args.per_gpu_eval_batch_size 
+    input_path = os.path.join(args.data_dir, input_file)
+    cached_features_file = os.path.join(args.data_dir, 'cached_{}_{}_{}_{}_{}'.format(
+        os.path.basename(input_file), args.model_type, args.max_seq_length, args.eval_batch_size, file_hash(input_path)[:16]))
+    if os.path.exists(cached_features_file) and not args.overwrite_cache:
+        logger.info("Loading features from cached file %s", cached_features_file)
+        return torch.load(cached_features_file)
+
+    eval_dataset = create_dataset(args, input_file)
+    batches = list(data_helper(args, eval_dataset, tokenizer, batch_processor, True))
+    if args.local_rank in [-1, 0]:
+        logger.info("Saving features into cached file %s", cached_features_file)
+        torch.save(batches, cached_features_file + '.tmp')
+        os.replace(cached_features_file + '.tmp', cached_features_file)
+    return batches
+
+def dev_subset(eval_batches, num_sentences):
+    '''The leading eval batches holding at least num_sentences sentences (all of them for 0).'''
+    if num_sentences <= 0:
+        return eval_batches
+    subset, count = [], 0
+    for batch in eval_batches:
+        if count >= num_sentences:
+            break
+        subset.append(batch)
+        count += len(batch['id'])
+    return subset
+
+def evaluate(args, model, tokenizer, batch_processor, prefix="", eval_batches=None, device=None):
+    '''
+    eval_batches are featurized batches shared between evaluations, they are not modified here.
+    They are loaded from args.dev_file when not given.
+    '''
+    if eval_batches is None:
+        eval_batches = load_eval_batches(args, args.dev_file, tokenizer, batch_processor)
+    device = device if device is not None else args.device
 
     logger.info("***** Running evaluation {} *****".format(prefix))
-    logger.info("  Num examples = %d", len(eval_dataset))
-    logger.info("  Batch size = %d", args.eval_batch_size)
+    logger.info("  Num examples = %d", sum(len(batch['id']) for batch in eval_batches))
+    logger.info("  Batch size = %d", args.per_gpu_eval_batch_size)
 
     eval_loss = 0.0
     nb_eval_steps = 0
 
-    batches = []
+    arrays, ids, tokens_size = [], [], []
+    merge_id = tokenizer.convert_tokens_to_ids('#')
 
-    for batch in data_helper(args, eval_dataset, tokenizer, batch_processor, True):
+    for eval_batch in eval_batches:
         model.eval()
+        batch = dict(eval_batch)
         for t in batch:
             if t not in ['id', 'src', 'tgt', 'lengths', 'tokens_size', 'pho_lens','pos_lens','wubi_lens']:
-                batch[t] = batch[t].to(args.device)
+                batch[t] = batch[t].to(device)
         with torch.no_grad():
             outputs = model(batch)
             tmp_eval_loss, logits = outputs[:2]
@@ -281,23 +677,94 @@ def evaluate(args, model, tokenizer, batch_processor, prefix=""):
         preds = logits.detach().cpu().numpy()
         preds = np.argmax(preds, axis=-1)
         batch['src_idx'] = batch['src_idx'].detach().cpu().numpy()
-        batch['pred_idx'] = preds
-
-        batches.append(batch)
-
-    metric = Metric(vocab_path=args.output_dir)
+        if hasattr(model, 'edit_classifier'):
+            # Edit-tagging models: decode merges and hand the metric the '#'-aligned form
+            edit_preds = outputs[3].argmax(dim=-1).cpu().numpy()
+            _, preds = merge_decode(batch['src_idx'], edit_preds, preds, batch['lengths'], merge_id)
+        arrays.append((batch['src_idx'], preds, batch['tgt_idx'].cpu().numpy(), np.asarray(batch['lengths'])))
+        ids.extend(batch['id'])
+        tokens_size.extend(batch['tokens_size'])
+
+    src_idx, pred_idx, tgt_idx, lengths = [np.concatenate(a) for a in zip(*arrays)]
+    # Gold ids from the label file of the dev file; without one (--dev_label_file '') the batch targets
+    if args.dev_label_file:
+        label_path = os.path.join(args.data_dir, args.dev_label_file)
+        if not os.path.exists(label_path):
+            raise ValueError("Label file %s does not exist" % label_path)
+        if args.dev_label_file.endswith('.npy'):
+            labels = load_labels(label_path)
+        elif args.dev_label_file.endswith('.pkl'):
+            raise ValueError("Label file %s: .pkl labels are not read, build a .npy one with "
+                             "data_process/build_lbl.py --npy_path" % label_path)
+        else:
+            labels = read_label_file(label_path, ids, tokenizer.vocab, tokenizer.vocab.get(tokenizer.unk_token, 0))
+        tgt_idx = gold_from_labels(labels, src_idx, tokens_size)
+    results = correction_metrics(src_idx, pred_idx, tgt_idx, lengths, merge_id)
+    results['avg_loss'] = eval_loss / max(nb_eval_steps, 1)
+    if hasattr(model, 'edit_classifier'):
+        results.update(edit_metrics(src_idx, pred_idx, tgt_idx, lengths, merge_id))
     pred_txt_path = os.path.join(args.output_dir, prefix, "preds.txt")
-    pred_lbl_path = os.path.join(args.output_dir, prefix, "labels.txt")
-    results = metric.metric(
-            batches=batches,
-            pred_txt_path=pred_txt_path,
-            pred_lbl_path=pred_lbl_path,
-            label_path=os.path.join(args.data_dir, args.dev_label_file)
-        )
+    os.makedirs(os.path.dirname(pred_txt_path), exist_ok=True)
+    tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer.vocab))))
+    write_predictions(pred_txt_path, ids, src_idx, pred_idx, lengths, tokens)
+    write_prediction_labels(os.path.join(args.output_dir, prefix, "labels.txt"), ids, src_idx, pred_idx, lengths, tokens)
     for key in sorted(results.keys()):
         logger.info("  %s = %s", key, str(results[key]))
     return results
 
+def evaluate_checkpoints(args, checkpoints, model_class, config, tokenizer, batch_processor, eval_batches):
+    '''
+    Evaluate checkpoints concurrently, one worker per GPU (or --eval_workers workers on CPU),
+    all sharing the same featurized eval_batches. Returns results in the order of checkpoints.
+    '''
+    if args.device.type == 'cuda' and args.n_gpu > 1:
+        devices = [torch.device('cuda', i) for i in range(args.n_gpu)]
+    else:
+        devices = [args.device] * max(1, args.eval_workers)
+    devices = devices[:max(1, len(checkpoints))]
+    num_threads = torch.get_num_threads()
+    if args.device.type == 'cpu' and len(devices) > 1:
+        # Workers share the intra-op thread pool, give each of them its part of the cores
+        torch.set_num_threads(max(1, num_threads // len(devices)))
+
+    jobs = queue.Queue()
+    for i, checkpoint in enumerate(checkpoints):
+        jobs.put((i, checkpoint))
+    results = [None] * len(checkpoints)
+    errors = []
+
+    def worker(device):
+        while not errors:
+            try:
+                i, checkpoint = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                prefix = checkpoint.split('/')[-1] if checkpoint.find('saved_ckpt-') != -1 else ""
+                model = load_checkpoint(model_class, checkpoint, config=config,
+                                        build_glyphs=lambda model: rebuild_glyphs(model, args))
+                model.to(device)
+                results[i] = evaluate(args, model, tokenizer, batch_processor, prefix=prefix,
+                                      eval_batches=eval_batches, device=device)
+                del model
+            except Exception as e:
+                errors.append(e)
+
+    try:
+        if len(devices) == 1:
+            worker(devices[0])
+        else:
+            threads = [threading.Thread(target=worker, args=(device,)) for device in devices]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        torch.set_num_threads(num_threads)
+    if errors:
+        raise errors[0]
+    return results
+
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
 
@@ -310,7 +777,7 @@ if __name__=='__main__':
     ## Other parameters
     parser.add_argument("--image_model_type", default=0, type=int)
     parser.add_argument("--model_name_or_path", default='/home/wtl/research/ReaLiSe/pretrained/pho_res_wubi', type=str,
-                        help="Path to pre-trained model or shortcut name selected in the list: " + ", ".join(ALL_MODELS))
+                        help="Path to pre-trained model or shortcut name")
     parser.add_argument("--font_path", default='/home/jhliang/Research/ReaLiSe/simhei.ttf', type=str)
     parser.add_argument("--data_dir", default="/home/jhliang/Research/ReaLiSe/data", type=str,
                         help="The input data dir. Should contain the .tsv files (or other data files) for the task.")
@@ -326,7 +793,9 @@ if __name__=='__main__':
 
     parser.add_argument("--train_file", default="/home/wtl/research/ReaLiSe/data/trainall.times2.pkl", type=str)
     parser.add_argument("--dev_file", default="test.sighan15.pkl", type=str)
-    parser.add_argument("--dev_label_file", default="test.sighan15.lbl.pkl", type=str)
+    parser.add_argument("--dev_label_file", default="test.sighan15.lbl.npy", type=str,
+                        help="Gold labels of dev_file: a .npy label array (data_process/build_lbl.py --npy_path) or a "
+                             "text label file (--lbl_path); '' to score against the targets of dev_file")
     parser.add_argument("--predict_file", default="test.sighan15.pkl", type=str)
     parser.add_argument("--predict_label_file", default="test.sighan15.lbl.tsv", type=str)
     
@@ -370,6 +839,8 @@ if __name__=='__main__':
                         help="Save checkpoint every X updates steps.")
     parser.add_argument("--eval_all_checkpoints", action='store_true',
                         help="Evaluate all checkpoints starting with the same prefix as model_name ending and ending with step number")
+    parser.add_argument("--eval_workers", default=1, type=int,
+                        help="Number of checkpoints evaluated concurrently on CPU (on GPUs there is one worker per device)")
     parser.add_argument("--no_cuda", action='store_true',
                         help="Avoid using CUDA when available")
     parser.add_argument('--overwrite_output_dir', action='store_true',
@@ -386,6 +857,54 @@ if __name__=='__main__':
                              "See details at https://nvidia.github.io/apex/amp.html")
     parser.add_argument("--local_rank", type=int, default=-1,
                         help="For distributed training: local_rank")
+    parser.add_argument('--freeze_branches', nargs='*', default=[], choices=['pho', 'wubi', 'res'],
+                        help="Modality branches to freeze; they run in eval mode under no_grad and get no optimizer state")
+    parser.add_argument('--cache_frozen_branches', action='store_true',
+                        help="Tabulate the per-token part (pho_gru, wubi_gru, resnet) of frozen branches over the vocab")
+    parser.add_argument('--save_training_state', action='store_true',
+                        help="Also save optimizer, scheduler, amp, RNG states and the data position with every checkpoint")
+    parser.add_argument('--resume_from_checkpoint', default='', type=str,
+                        help="Checkpoint saved with --save_training_state to resume training from")
+    parser.add_argument('--gradient_checkpointing', action='store_true',
+                        help="Recompute activations of bert, pho_model, wubi_model, output_block, resnet and the detector GRU "
+                             "in the backward pass to save memory")
+    parser.add_argument('--profile_steps', type=int, default=0,
+                        help="Profile the forward of the first N training steps per branch (wall/CUDA time, FLOPs, peak memory)")
+    parser.add_argument('--profile_output', type=str, default='',
+                        help="JSON file for the per-step profile and its summary, default output_dir/profile.json")
+    parser.add_argument('--profile_tensorboard', action='store_true',
+                        help="Also write the profile as TensorBoard scalars under output_dir/profile")
+    parser.add_argument('--dataloader_workers', type=int, default=0,
+                        help="Worker processes featurizing (and augmenting) training batches, 0 to do it in the training loop")
+    parser.add_argument('--augment_prob', type=float, default=0.0,
+                        help="Share of training examples re-corrupted from their target every epoch, 0 to disable")
+    parser.add_argument('--chaizi_path', default='', type=str,
+                        help="Chaizi file (char \\t ... \\t radicals) the split errors are drawn from")
+    parser.add_argument('--augment_split_prob', type=float, default=0.05, help="Per character probability of a split")
+    parser.add_argument('--augment_pho_prob', type=float, default=0.05, help="Per character probability of a homophone")
+    parser.add_argument('--augment_wubi_prob', type=float, default=0.03,
+                        help="Per character probability of a character with the same leading wubi keys")
+    parser.add_argument('--augment_max_errors', type=int, default=3)
+    parser.add_argument('--eval_steps', type=int, default=0,
+                        help="Evaluate on the dev subset every X updates steps and keep the --num_save_ckpts best checkpoints (replaces --save_steps)")
+    parser.add_argument('--eval_subset_size', type=int, default=0,
+                        help="Dev sentences evaluated by --eval_steps, 0 for the whole dev file")
+    parser.add_argument('--early_stopping_patience', type=int, default=0,
+                        help="Stop after this many --eval_steps evaluations without improvement, 0 to disable")
+    parser.add_argument('--early_stopping_delta', type=float, default=0.0,
+                        help="Smallest change of --order_metric counted as an improvement")
+    parser.add_argument('--hard_example_sampling', action='store_true',
+                        help="Draw epochs by per-example training loss instead of a uniform shuffle")
+    parser.add_argument('--sampling_temperature', type=float, default=1.0,
+                        help="Softmax temperature over example losses, higher is closer to uniform")
+    parser.add_argument('--clean_replay_floor', type=float, default=0.1,
+                        help="Share of every epoch drawn uniformly from the clean (src == tgt) examples")
+    parser.add_argument('--loss_momentum', type=float, default=0.5,
+                        help="Weight of the previous loss of an example when a new one is recorded")
+    parser.add_argument('--target_value', type=float, default=None,
+                        help="Value of --order_metric whose first checkpoint is reported as steps to target")
+    parser.add_argument('--pack_sequences', action='store_true',
+                        help="Pack several training sentences into each max_seq_length row, with attention kept inside each sentence")
     
     parser.add_argument('--num_fonts', type=int, default=1)
     parser.add_argument('--use_traditional_font', action='store_true')
@@ -394,6 +913,10 @@ if __name__=='__main__':
     parser.add_argument('--with_res', default='yes', choices=['yes', 'no'])
     parser.add_argument('--with_wubi', default='yes',choices=['yes','no'])
     parser.add_argument('--fusion', default='gate', choices=['gate', 'sum'])
+    parser.add_argument('--contrastive_negatives', type=int, default=None,
+                        help="Hard negatives per row of the contrastive loss (Contrast models)")
+    parser.add_argument('--contrastive_temperature', type=float, default=None)
+    parser.add_argument('--contrastive_mode', default=None, choices=['margin', 'infonce'])
 
     args = parser.parse_args()
 
@@ -435,6 +958,15 @@ if __name__=='__main__':
 
     args.model_type = args.model_type.lower()
     config_class, model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
+    from models import enable_gradient_checkpointing, freeze_branches, build_branch_cache
+    logger.info("Startup imports: %s (%.2fs in total)", ", ".join("%s %.2fs" % x for x in IMPORT_TIMES.items()),
+                sum(IMPORT_TIMES.values()))
+    if args.pack_sequences and not getattr(model_class, 'supports_packing', False):
+        raise ValueError("--pack_sequences is not supported by model type %s" % args.model_type)
+    if args.eval_steps > 0 and args.local_rank != -1:
+        raise ValueError("--eval_steps is only supported in single process training")
+    if args.hard_example_sampling and not hasattr(model_class, 'track_example_losses'):
+        raise ValueError("--hard_example_sampling is not supported by model type %s" % args.model_type)
     config = config_class.from_pretrained(args.config_name if args.config_name else args.model_name_or_path,
                                           image_model_type=args.image_model_type,
                                           cache_dir=args.cache_dir if args.cache_dir else None)
@@ -443,6 +975,9 @@ if __name__=='__main__':
     config.with_pho = args.with_pho
     config.with_res = args.with_res
     config.fusion = args.fusion
+    for name in ('contrastive_negatives', 'contrastive_temperature', 'contrastive_mode'):
+        if getattr(args, name) is not None:
+            setattr(config, name, getattr(args, name))
     tokenizer = tokenizer_class.from_pretrained(args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
                                                 do_lower_case=args.do_lower_case,
                                                 cache_dir=args.cache_dir if args.cache_dir else None)
@@ -451,19 +986,35 @@ if __name__=='__main__':
     model.tie_cls_weight()
 
     if args.with_res == 'yes':
+        rebuild_glyphs(model, args)
         if args.num_fonts == 1:
-            model.build_glyce_embed(args.model_name_or_path, args.font_path)
             print(f'model_type: {args.model_type}, num_fonts: {args.num_fonts}, build_glyce_embed() done')
         else:
-            model.build_glyce_embed_multifonts(args.model_name_or_path, args.num_fonts, args.use_traditional_font)
             print(f'model_type: {args.model_type}, num_fonts: {args.num_fonts}')
             print(f'use_traditional_font: {args.use_traditional_font}, build_glyce_embed() done')
-        
-        
+
+    # Checkpoints point to one copy of the rendered glyphs instead of storing them
+    args.glyph_cache_path = None
+    if args.do_train and args.with_res == 'yes' and args.local_rank in [-1, 0]:
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+        args.glyph_cache_path = save_glyph_cache(model, os.path.join(args.output_dir, GLYPH_CACHE_NAME))
+
     batch_processor = model_class.build_batch
 
+    if args.gradient_checkpointing:
+        branches = enable_gradient_checkpointing(model)
+        logger.info("Gradient checkpointing enabled for: %s", ", ".join(branches))
+
     model.to(args.device)
 
+    if args.freeze_branches:
+        frozen = freeze_branches(model, args.freeze_branches)
+        logger.info("Frozen branches: %s", ", ".join(frozen))
+        if args.cache_frozen_branches:
+            cached = build_branch_cache(model, tokenizer, frozen)
+            logger.info("Cached per-vocab outputs of frozen branches: %s", ", ".join(cached))
+
     logger.info("Training/evaluation parameters %s", args)
 
     # Training
@@ -477,15 +1028,12 @@ if __name__=='__main__':
         if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
             os.makedirs(args.output_dir)
         logger.info("Saving model checkpoint to %s", args.output_dir)
-        # Save a trained model, configuration and tokenizer using `save_pretrained()`.
-        # They can then be reloaded using `from_pretrained()`
-        model_to_save = model.module if hasattr(model, 'module') else model  # Take care of distributed/parallel training
-        model_to_save.save_pretrained(args.output_dir)
+        # Save a trained model, configuration, training arguments and tokenizer.
+        # They can then be reloaded using `load_checkpoint()`
+        save_checkpoint(model, args.output_dir, args, glyph_cache_path=args.glyph_cache_path)
         tokenizer.save_pretrained(args.output_dir)
-        # Good practice: save your training arguments together with the trained model
-        torch.save(args, os.path.join(args.output_dir, 'training_args.bin'))
         # Load a trained model and vocabulary that you have fine-tuned
-        model = model_class.from_pretrained(args.output_dir)
+        model = load_checkpoint(model_class, args.output_dir, build_glyphs=lambda model: rebuild_glyphs(model, args))
         tokenizer = tokenizer_class.from_pretrained(args.output_dir)
         model.to(args.device)
 
@@ -500,13 +1048,10 @@ if __name__=='__main__':
         best_ckpt_dirs = []
         results = {}
 
-        for checkpoint in checkpoints:
+        eval_batches = load_eval_batches(args, args.dev_file, tokenizer, batch_processor)
+        ckpt_results = evaluate_checkpoints(args, checkpoints, model_class, config, tokenizer, batch_processor, eval_batches)
+        for checkpoint, result in zip(checkpoints, ckpt_results):
             global_step = checkpoint.split('-')[-1] if len(checkpoints) > 1 else ""
-            prefix = checkpoint.split('/')[-1] if checkpoint.find('saved_ckpt-') != -1 else ""
-            
-            model = model_class.from_pretrained(checkpoint, config=config)
-            model.to(args.device)
-            result = evaluate(args, model, tokenizer, batch_processor, prefix=prefix)
             best_ckpt_dirs.append((result[args.order_metric], checkpoint))
             
             result = dict((k + '_{}'.format(global_step), v) for k, v in result.items())
@@ -517,12 +1062,23 @@ if __name__=='__main__':
 
         json.dump(results, open(os.path.join(args.output_dir, 'dev_results.json'), 'w', encoding='utf-8'), indent=4)
 
+        if args.target_value is not None:
+            from sampling import steps_to_target
+            step_results = [(int(c.split('-')[-1]), r) for c, r in zip(checkpoints, ckpt_results) if c.find('saved_ckpt-') != -1]
+            steps = steps_to_target(step_results, args.order_metric, args.target_value, higher_is_better=args.metric_reverse)
+            logger.info("Steps to %s = %s: %s (%s sampling)", args.order_metric, args.target_value, steps,
+                        'hard example' if args.hard_example_sampling else 'uniform')
+            json.dump({'metric': args.order_metric, 'target': args.target_value, 'steps_to_target': steps,
+                       'sampling': 'hard' if args.hard_example_sampling else 'uniform',
+                       'sampling_temperature': args.sampling_temperature, 'clean_replay_floor': args.clean_replay_floor},
+                      open(os.path.join(args.output_dir, 'convergence.json'), 'w', encoding='utf-8'), indent=4)
+
         if args.remove_unused_ckpts:
             for checkpoint in checkpoints:
                 prefix = checkpoint.split('/')[-1] if checkpoint.find('saved_ckpt-') != -1 else ""
                 if len(prefix) != 0 and (checkpoint not in best_ckpt_dirs):
                     logger.info("Deleting ckpt: %s", checkpoint)
-                    os.system("rm -rf %s"%checkpoint)
+                    shutil.rmtree(checkpoint, ignore_errors=True)
 
     if args.do_predict and args.local_rank in [-1, 0]:
         checkpoints = list(os.path.dirname(c) for c in sorted(glob.glob(args.output_dir + '/**/' + WEIGHTS_NAME, recursive=True)))
@@ -533,13 +1089,10 @@ if __name__=='__main__':
         args.dev_label_file = args.predict_label_file
         results = {}
 
-        for checkpoint in checkpoints:
+        eval_batches = load_eval_batches(args, args.dev_file, tokenizer, batch_processor)
+        ckpt_results = evaluate_checkpoints(args, checkpoints, model_class, config, tokenizer, batch_processor, eval_batches)
+        for checkpoint, result in zip(checkpoints, ckpt_results):
             global_step = checkpoint.split('-')[-1] if len(checkpoints) > 1 else ""
-            prefix = checkpoint.split('/')[-1] if checkpoint.find('saved_ckpt-') != -1 else ""
-            
-            model = model_class.from_pretrained(checkpoint, config=config)
-            model.to(args.device)
-            result = evaluate(args, model, tokenizer, batch_processor, prefix=prefix)
             result = dict((k + '_{}'.format(global_step), v) for k, v in result.items())
             results.update(result)
 
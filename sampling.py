@@ -0,0 +1,80 @@
+'''Loss-aware sampling of training examples.
+
+HardExampleSampler draws each epoch's order with probability softmax(loss / temperature) over the
+last recorded loss of every example, mixed with a uniform replay floor over the clean (src == tgt)
+examples so that they are not forgotten. Examples not seen yet count as the hardest ones.
+The losses come from the training forward (see models' track_example_losses).
+'''
+
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_clean(example):
+    return example['src_idx'] == example['tgt_idx']
+
+
+class HardExampleSampler(object):
+
+    def __init__(self, clean, temperature=1.0, clean_floor=0.1, momentum=0.5, seed=42):
+        self.clean = np.asarray(clean, dtype=bool)
+        self.temperature = temperature
+        self.clean_floor = clean_floor if self.clean.any() else 0.0
+        self.momentum = momentum
+        self.seed = seed
+        self.losses = np.full(len(self.clean), np.nan)
+
+    @classmethod
+    def from_dataset(cls, dataset, **kwargs):
+        return cls([is_clean(dataset[j]) for j in range(len(dataset))], **kwargs)
+
+    def __len__(self):
+        return len(self.clean)
+
+    def update(self, indices, losses):
+        '''Exponential moving average of the loss of the given examples.'''
+        indices, losses = np.asarray(indices), np.asarray(losses, dtype=np.float64)
+        previous = self.losses[indices]
+        self.losses[indices] = np.where(np.isnan(previous), losses,
+                                        self.momentum * previous + (1 - self.momentum) * losses)
+
+    def probabilities(self):
+        losses = self.losses
+        if np.isnan(losses).all():
+            p = np.full(len(losses), 1.0 / len(losses))
+        else:
+            losses = np.where(np.isnan(losses), np.nanmax(losses), losses)
+            logits = losses / self.temperature
+            p = np.exp(logits - logits.max())
+            p /= p.sum()
+        if self.clean_floor > 0:
+            p = (1 - self.clean_floor) * p + self.clean_floor * self.clean / self.clean.sum()
+        return p
+
+    def epoch_order(self, epoch):
+        '''len(self) example indices drawn with replacement, deterministic given (seed, epoch) and the losses.'''
+        p = self.probabilities()
+        rng = np.random.RandomState((self.seed * 1000003 + epoch) % 2**32)
+        order = rng.choice(len(p), size=len(p), replace=True, p=p)
+        logger.info("  Hard example sampling: %d distinct examples, %.1f%% clean (%.1f%% of the data)",
+                    len(np.unique(order)), 100 * self.clean[order].mean(), 100 * self.clean.mean())
+        return order.tolist()
+
+    def state_dict(self):
+        return {'losses': self.losses.copy()}
+
+    def load_state_dict(self, state):
+        self.losses = state['losses'].copy()
+
+
+def steps_to_target(step_results, metric, target, higher_is_better=True):
+    '''First global step of [(step, results)] whose metric reaches target, or None.'''
+    for step, results in sorted(step_results, key=lambda x: x[0]):
+        value = results.get(metric)
+        if value is not None and (value >= target if higher_is_better else value <= target):
+            return step
+    return None
@@ -0,0 +1,169 @@
+'''Vectorized detection / correction metrics over '#'-aligned id arrays.
+
+All inputs are [N, S] arrays with [CLS] at position 0 and the sentence at 1..length. A position is an
+error when the gold id differs from the source id, a prediction when the predicted id does.
+Errors are typed: 'merge' for the two positions of a split character (gold '#' then the merged
+character, src 白勺 -> tgt #的), 'spell' for the others. Metrics are computed
+
+    char level      detection: predicted error positions that are gold errors
+                    correction: ... predicted with the gold character
+    sentence level  detection: the predicted error positions of a sentence equal the gold ones
+                    correction: ... and all of them carry the gold character
+
+overall and restricted to each error type.
+'''
+
+import numpy as np
+
+
+def _prf(tp, n_pred, n_gold):
+    p = tp / n_pred if n_pred > 0 else 0.0
+    r = tp / n_gold if n_gold > 0 else 0.0
+    f = 2 * p * r / (p + r) if p + r > 0 else 0.0
+    return float(p), float(r), float(f)
+
+
+def _merge_positions(aligned, merge_id):
+    merge = aligned == merge_id
+    return merge | np.concatenate((np.zeros_like(merge[:, :1]), merge[:, :-1]), axis=1)
+
+
+def _level_metrics(prefix, pred_err, gold_err, correct, results):
+    '''Char and sentence level P/R/F of boolean [N, S] predicted / gold errors.'''
+    hit = pred_err & gold_err
+    n_pred, n_gold = pred_err.sum(), gold_err.sum()
+    for name, tp in (('det', hit.sum()), ('cor', (hit & correct).sum())):
+        p, r, f = _prf(tp, n_pred, n_gold)
+        results['%schar_%s_p' % (prefix, name)], results['%schar_%s_r' % (prefix, name)], results['%schar_%s_f' % (prefix, name)] = p, r, f
+
+    pred_any, gold_any = pred_err.any(axis=1), gold_err.any(axis=1)
+    det_match = (pred_err == gold_err).all(axis=1)
+    cor_match = det_match & (correct | ~gold_err).all(axis=1)
+    for name, match in (('det', det_match), ('cor', cor_match)):
+        p, r, f = _prf((match & pred_any & gold_any).sum(), pred_any.sum(), gold_any.sum())
+        results['%ssent_%s_acc' % (prefix, name)] = float(match.mean()) if len(match) else 0.0
+        results['%ssent_%s_p' % (prefix, name)], results['%ssent_%s_r' % (prefix, name)], results['%ssent_%s_f' % (prefix, name)] = p, r, f
+
+
+# Names (and percent scale) of the sentence level metrics of the previous per-sentence Metric,
+# still reported so that --order_metric values and result parsers keep working
+LEGACY_KEYS = dict(('sent-%s-%s' % (old_level, old_name), 'sent_%s_%s' % (level, name))
+                   for old_level, level in (('detect', 'det'), ('correct', 'cor'))
+                   for old_name, name in (('acc', 'acc'), ('p', 'p'), ('r', 'r'), ('f1', 'f')))
+
+
+def correction_metrics(src_idx, pred_idx, gold_idx, lengths, merge_id):
+    '''Dict of char / sentence level det / cor P/R/F (and sentence accuracy), overall and per error type.'''
+    src_idx, pred_idx, gold_idx = np.asarray(src_idx), np.asarray(pred_idx), np.asarray(gold_idx)
+    positions = np.arange(src_idx.shape[1])[None, :]
+    active = (positions >= 1) & (positions <= np.asarray(lengths)[:, None])
+    pred_err = (pred_idx != src_idx) & active
+    gold_err = (gold_idx != src_idx) & active
+    correct = pred_idx == gold_idx
+
+    results = {}
+    _level_metrics('', pred_err, gold_err, correct, results)
+    # Gold errors are typed by the gold form, predictions by their own
+    gold_merge, pred_merge = _merge_positions(gold_idx, merge_id), _merge_positions(pred_idx, merge_id)
+    _level_metrics('merge_', pred_err & pred_merge, gold_err & gold_merge, correct, results)
+    _level_metrics('spell_', pred_err & ~pred_merge, gold_err & ~gold_merge, correct, results)
+    results['num_sentences'] = int(src_idx.shape[0])
+    results['num_gold_merge'] = int((gold_idx == merge_id)[active].sum())
+    results['num_gold_spell'] = int((gold_err & ~gold_merge).sum())
+    for old_key, key in LEGACY_KEYS.items():
+        results[old_key] = 100 * results[key]
+    return results
+
+
+# Binary labels written by data_process/build_lbl.py --npy_path: one row per gold error, with the
+# 0-based char position in the sentence. gold_from_labels maps it to the token position with the
+# tokens_size of the sentence (char position + 1 when every token is one char)
+LABEL_DTYPE = np.dtype([('sentence', np.int32), ('position', np.int32), ('char_id', np.int32)])
+
+
+def load_labels(path):
+    labels = np.load(path, mmap_mode='r', allow_pickle=False)
+    if labels.dtype != LABEL_DTYPE:
+        raise ValueError('%s is not a label array of dtype %s' % (path, LABEL_DTYPE))
+    return labels
+
+
+def token_positions(labels, tokens_size):
+    '''Position in the [N, S] ids (after [CLS]) of the token holding the char of every label, -1 past the sentence.'''
+    ends = {}
+    positions = np.full(len(labels), -1, dtype=np.int64)
+    for k, (sentence, position) in enumerate(zip(labels['sentence'].tolist(), labels['position'].tolist())):
+        if sentence >= len(tokens_size) or position < 0:
+            continue
+        if sentence not in ends:
+            ends[sentence] = np.cumsum(tokens_size[sentence])
+        token = int(np.searchsorted(ends[sentence], position, side='right'))
+        if token < len(ends[sentence]):
+            positions[k] = token + 1
+    return positions
+
+
+def gold_from_labels(labels, src_idx, tokens_size=None):
+    '''
+    Gold [N, S] ids: src_idx with the labelled errors of its N sentences applied. Without the
+    tokens_size of the sentences, every token is taken to be one char.
+    '''
+    gold = np.array(src_idx, copy=True)
+    if tokens_size is None:
+        positions = labels['position'].astype(np.int64) + 1
+    else:
+        positions = token_positions(labels, tokens_size)
+    keep = (labels['sentence'] < gold.shape[0]) & (positions >= 1) & (positions < gold.shape[1])
+    gold[labels['sentence'][keep], positions[keep]] = labels['char_id'][keep]
+    return gold
+
+
+def read_label_file(path, sentence_ids, vocab, unk_id):
+    '''
+    LABEL_DTYPE array of a text label file (build_lbl.py --lbl_path, the SIGHAN format): one
+    "id, position, char, position, char, ..." or "id, 0" line per sentence, 1-based positions.
+    Sentences are matched to sentence_ids by id; lines of other sentences are skipped.
+    '''
+    sentence_index = dict((sentence_id, i) for i, sentence_id in enumerate(sentence_ids))
+    rows = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = [field.strip() for field in line.strip().split(',')]
+            if fields[0] not in sentence_index or len(fields) < 3:
+                continue
+            for position, char in zip(fields[1::2], fields[2::2]):
+                rows.append((sentence_index[fields[0]], int(position) - 1, vocab.get(char, unk_id)))
+    return np.array(rows, dtype=LABEL_DTYPE)
+
+
+def decode_texts(ids, lengths, tokens, merge_token='#'):
+    '''Sentence text of every row of [N, S] ids, with the '#' of merged characters dropped.'''
+    tokens = np.asarray(tokens, dtype=object)
+    texts = tokens[np.asarray(ids)]
+    return [''.join(t for t in row[1:length + 1] if t != merge_token).replace('##', '')
+            for row, length in zip(texts, lengths)]
+
+
+def write_predictions(path, sentence_ids, src_idx, pred_idx, lengths, tokens):
+    '''preds.txt: id \\t source \\t prediction per line, written at once.'''
+    sources = decode_texts(src_idx, lengths, tokens)
+    predictions = decode_texts(pred_idx, lengths, tokens)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join('%s\t%s\t%s' % row for row in zip(sentence_ids, sources, predictions)))
+        f.write('\n')
+
+
+def write_prediction_labels(path, sentence_ids, src_idx, pred_idx, lengths, tokens):
+    '''labels.txt: the predicted corrections in the format of read_label_file, written at once.'''
+    src_idx, pred_idx = np.asarray(src_idx), np.asarray(pred_idx)
+    positions = np.arange(src_idx.shape[1])[None, :]
+    changed = (pred_idx != src_idx) & (positions >= 1) & (positions <= np.asarray(lengths)[:, None])
+    rows = []
+    for sentence_id, row_changed, row_pred in zip(sentence_ids, changed, pred_idx):
+        fields = [sentence_id]
+        for position in np.flatnonzero(row_changed).tolist():
+            fields += [str(position), tokens[row_pred[position]]]
+        rows.append(', '.join(fields if len(fields) > 1 else fields + ['0']))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(rows))
+        f.write('\n')